@@ -0,0 +1,604 @@
+#
+# an in-process fake of the parts of python-ldap used by bluepages, for
+# benchmarking syncbp and exportbp without an AD or ldap server
+#
+
+import collections
+import sys
+import time
+import types
+
+
+# the numbers python-ldap uses
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+MOD_ADD = 0
+MOD_DELETE = 1
+MOD_REPLACE = 2
+RES_ADD = 105
+RES_DELETE = 107
+RES_MODIFY = 103
+RES_SEARCH_RESULT = 101
+OPT_NETWORK_TIMEOUT = 0x5005
+
+# the AD rule for following nested group membership
+CHAIN_RULE = '1.2.840.113556.1.4.1941'
+
+# attributes with an equality index, so searches on them don't have to look
+# at every entry
+INDEXED = {'objectclass', 'objectcategory', 'samaccountname', 'uid', 'cn', 'member'}
+
+
+class LDAPError(Exception):
+    pass
+
+
+class SERVER_DOWN(LDAPError):
+    pass
+
+
+class NO_SUCH_OBJECT(LDAPError):
+    pass
+
+
+class TIMEOUT(LDAPError):
+    pass
+
+
+class ALREADY_EXISTS(LDAPError):
+    pass
+
+
+class OTHER(LDAPError):
+    pass
+
+
+def error(cls, desc, info=''):
+    return cls({'desc': desc, 'info': info})
+
+
+def parse_filter(text):
+    """
+    Parse an ldap search filter into nested tuples: ('&', [filters]),
+    ('|', [filters]), ('!', filter) or (operator, attribute, value) where the
+    operator is one of =, >=, <=, present, substring or the OID of an
+    extensible match rule.
+    """
+    (f, i) = _parse(text, 0)
+    if i != len(text):
+        raise error(OTHER, "Bad search filter", text)
+    return f
+
+
+def _unescape(value):
+    out = bytearray()
+    i = 0
+    raw = value.encode()
+    while i < len(raw):
+        if raw[i:i + 1] == b'\\':
+            out.append(int(raw[i + 1:i + 3], 16))
+            i += 3
+        else:
+            out.append(raw[i])
+            i += 1
+    return out.decode()
+
+
+def _parse(text, i):
+    if text[i] != '(':
+        raise error(OTHER, "Bad search filter", text)
+    i += 1
+    if text[i] in '&|':
+        op = text[i]
+        i += 1
+        subs = []
+        while text[i] == '(':
+            (sub, i) = _parse(text, i)
+            subs.append(sub)
+        return ((op, subs), i + 1)
+    if text[i] == '!':
+        (sub, i) = _parse(text, i + 1)
+        return (('!', sub), i + 1)
+
+    # escaped values never contain a bare ), so the item runs to the next one
+    j = text.index(')', i)
+    item = text[i:j]
+    for op in ('>=', '<='):
+        if op in item:
+            (attribute, value) = item.split(op, 1)
+            return ((op, attribute.lower(), _unescape(value)), j + 1)
+    (attribute, value) = item.split('=', 1)
+    if attribute.endswith(':'):
+        # extensible match, attribute:rule:=value
+        (attribute, rule) = attribute[:-1].split(':', 1)
+        return ((rule, attribute.lower(), _unescape(value)), j + 1)
+    if value == '*':
+        return (('present', attribute.lower(), None), j + 1)
+    if '*' in value:
+        return (('substring', attribute.lower(),
+                [_unescape(v).lower() for v in value.split('*')]), j + 1)
+    return (('=', attribute.lower(), _unescape(value)), j + 1)
+
+
+class Entry:
+    """An entry in the fake directory, with its values indexed by lower case attribute"""
+
+    def __init__(self, dn, attrs):
+        self.dn = dn
+        self.attrs = {}
+        for (name, values) in attrs.items():
+            if values:
+                self.attrs[name] = [v if isinstance(v, bytes) else v.encode()
+                        for v in values]
+
+    def values(self, attribute):
+        for (name, values) in self.attrs.items():
+            if name.lower() == attribute:
+                return [str(v, encoding='utf-8', errors='replace') for v in values]
+        return []
+
+
+class Server:
+    """
+    A fake directory server. Entries are held in memory with a few equality
+    indexes, and the AD specific bits bluepages relies on are emulated: the
+    rootDSE USN, uSNChanged on every entry and the chain rule for nested
+    group membership.
+
+    Every request takes `latency` seconds to come back. Asynchronous
+    requests overlap, so a client which keeps several in flight sees the
+    benefit as it would against a real server. `max_page_size` caps the
+    page size like the AD MaxPageSize policy. The operations requested of
+    the server are counted in `ops`. Setting `down` makes every request
+    fail with SERVER_DOWN, like a DC that has gone away.
+    """
+
+    def __init__(self, latency=0.0, max_page_size=1000, name='CN=NTDS Settings,CN=DC01'):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.down = False
+        self.name = name
+        self.entries = {}
+        self.index = collections.defaultdict(set)
+        self.usn = 1000
+        self.ops = collections.Counter()
+        self.closure = {}
+
+    # writes
+
+    def _index(self, entry, add=True):
+        for name in entry.attrs:
+            if name.lower() in INDEXED:
+                for value in entry.values(name.lower()):
+                    key = (name.lower(), value.lower())
+                    if add:
+                        self.index[key].add(entry.dn.lower())
+                    else:
+                        self.index[key].discard(entry.dn.lower())
+
+    def _touch(self, entry):
+        self.usn += 1
+        entry.attrs['uSNChanged'] = [str(self.usn).encode()]
+        self.closure = {}
+
+    def add(self, dn, attrs):
+        if dn.lower() in self.entries:
+            raise error(ALREADY_EXISTS, "Already exists", dn)
+        entry = Entry(dn, attrs)
+        self._touch(entry)
+        self.entries[dn.lower()] = entry
+        self._index(entry)
+        return entry
+
+    def modify(self, dn, modlist):
+        entry = self.entries.get(dn.lower())
+        if entry is None:
+            raise error(NO_SUCH_OBJECT, "No such object", dn)
+        self._index(entry, False)
+        names = {name.lower(): name for name in entry.attrs}
+        for (op, attribute, values) in modlist:
+            name = names.get(attribute.lower(), attribute)
+            values = [v if isinstance(v, bytes) else v.encode() for v in values or []]
+            if op == MOD_REPLACE or (op == MOD_DELETE and not values):
+                entry.attrs.pop(name, None)
+                if op == MOD_REPLACE and values:
+                    entry.attrs[name] = values
+            elif op == MOD_ADD:
+                entry.attrs.setdefault(name, []).extend(values)
+            elif op == MOD_DELETE:
+                entry.attrs[name] = [v for v in entry.attrs.get(name, [])
+                        if v not in values]
+                if not entry.attrs[name]:
+                    del entry.attrs[name]
+            names[attribute.lower()] = name
+        self._touch(entry)
+        self._index(entry)
+
+    def delete(self, dn):
+        entry = self.entries.pop(dn.lower(), None)
+        if entry is None:
+            raise error(NO_SUCH_OBJECT, "No such object", dn)
+        self._index(entry, False)
+        self.usn += 1
+        self.closure = {}
+
+    # searches
+
+    def _members(self, dn):
+        """The DNs (lower case) of everything in a group, following nesting"""
+        key = ('members', dn.lower())
+        if key not in self.closure:
+            found = set()
+            todo = [dn.lower()]
+            while todo:
+                group = self.entries.get(todo.pop())
+                if group is None:
+                    continue
+                for member in group.values('member'):
+                    if member.lower() not in found:
+                        found.add(member.lower())
+                        todo.append(member.lower())
+            self.closure[key] = found
+        return self.closure[key]
+
+    def _containers(self, dn):
+        """The DNs (lower case) of every group an entry is in, following nesting"""
+        key = ('containers', dn.lower())
+        if key not in self.closure:
+            found = set()
+            todo = [dn.lower()]
+            while todo:
+                for group in self.index.get(('member', todo.pop()), ()):
+                    if group not in found:
+                        found.add(group)
+                        todo.append(group)
+            self.closure[key] = found
+        return self.closure[key]
+
+    def _candidates(self, f):
+        """The DNs which could match a filter, or None if we'd have to look at everything"""
+        if f[0] == '=' and f[1] in INDEXED:
+            return self.index.get((f[1], f[2].lower()), set())
+        if f[0] == CHAIN_RULE and f[1] == 'memberof':
+            return self._members(f[2])
+        if f[0] == CHAIN_RULE and f[1] == 'member':
+            return self._containers(f[2])
+        if f[0] == '&':
+            found = [c for c in map(self._candidates, f[1]) if c is not None]
+            return min(found, key=len) if found else None
+        if f[0] == '|':
+            found = [self._candidates(sub) for sub in f[1]]
+            if all(c is not None for c in found):
+                return set().union(*found)
+        return None
+
+    def _match(self, entry, f):
+        op = f[0]
+        if op == '&':
+            return all(self._match(entry, sub) for sub in f[1])
+        if op == '|':
+            return any(self._match(entry, sub) for sub in f[1])
+        if op == '!':
+            return not self._match(entry, f[1])
+
+        (attribute, value) = f[1:]
+        if op == CHAIN_RULE and attribute == 'memberof':
+            return entry.dn.lower() in self._members(value)
+        if op == CHAIN_RULE and attribute == 'member':
+            return entry.dn.lower() in self._containers(value)
+        if attribute == 'distinguishedname':
+            values = [entry.dn]
+        else:
+            values = entry.values(attribute)
+        if op == 'present':
+            return bool(values)
+        if op == 'substring':
+            return any(_substring(v.lower(), value) for v in values)
+        if op == '=':
+            return value.lower() in (v.lower() for v in values)
+        if op in ('>=', '<='):
+            for v in values:
+                (a, b) = (int(v), int(value)) if v.isdigit() and value.isdigit() else (v, value)
+                if (op == '>=' and a >= b) or (op == '<=' and a <= b):
+                    return True
+            return False
+        raise error(OTHER, "Unsupported filter", str(f))
+
+    def search(self, base, scope, criteria, attributes=None, sort=None):
+        """Return the (dn, attrs) results of a search"""
+        if base == '' and scope == SCOPE_BASE:
+            return [('', {'dsServiceName': [self.name.encode()],
+                    'highestCommittedUSN': [str(self.usn).encode()]})]
+
+        f = parse_filter(criteria)
+        base = base.lower()
+        candidates = self._candidates(f)
+        if candidates is None:
+            entries = self.entries.values()
+        else:
+            # sorted so the results come back in the same order every time
+            entries = (self.entries[dn] for dn in sorted(candidates)
+                    if dn in self.entries)
+
+        results = []
+        for entry in entries:
+            dn = entry.dn.lower()
+            if scope == SCOPE_BASE and dn != base:
+                continue
+            if scope != SCOPE_BASE and not (dn == base or dn.endswith(',' + base)):
+                continue
+            if not self._match(entry, f):
+                continue
+            if attributes:
+                wanted = {a.lower() for a in attributes}
+                attrs = {k: v for (k, v) in entry.attrs.items() if k.lower() in wanted}
+                if 'distinguishedname' in wanted:
+                    attrs['distinguishedName'] = [entry.dn.encode()]
+                if 'memberof' in wanted:
+                    # the back link AD keeps of the groups an entry is directly in
+                    groups = sorted(self.entries[g].dn for g in self.index.get(('member', dn), ()))
+                    if groups:
+                        attrs['memberOf'] = [g.encode() for g in groups]
+            else:
+                attrs = dict(entry.attrs)
+            results.append((entry.dn, attrs))
+
+        if sort:
+            (attribute, rule) = (sort.split(':') + [None])[:2]
+            results.sort(key=lambda r: min([str(v, encoding='utf-8') for (k, vs) in r[1].items()
+                    if k.lower() == attribute.lower() for v in vs] or ['']))
+        return results
+
+
+def _substring(value, parts):
+    if not value.startswith(parts[0]) or not value.endswith(parts[-1]):
+        return False
+    pos = len(parts[0])
+    for part in parts[1:-1]:
+        pos = value.find(part, pos)
+        if pos < 0:
+            return False
+        pos += len(part)
+    return len(value) - len(parts[-1]) >= pos
+
+
+class Connection:
+    """
+    A connection to a fake Server, with the LDAPObject methods bluepages
+    uses. The synchronous methods wait for the server latency, the
+    asynchronous ones return a message id straight away and result3() waits
+    for whatever is left of the latency of that request. If that is longer
+    than the timeout attribute (as in python-ldap, -1 for none) TIMEOUT is
+    raised once the timeout has passed.
+    """
+
+    def __init__(self, server, controls):
+        self.server = server
+        self.controls = controls
+        self.msgid = 0
+        self.pending = {}
+        self.searches = {}
+        self.timeout = -1
+
+    def _wait(self, delay=None, timeout=None):
+        if self.server.down:
+            raise error(SERVER_DOWN, "Can't contact LDAP server")
+        delay = self.server.latency if delay is None else delay
+        timeout = self.timeout if timeout is None else timeout
+        if timeout >= 0 and delay > timeout:
+            time.sleep(timeout)
+            raise error(TIMEOUT, "Timed out")
+        if delay > 0:
+            time.sleep(delay)
+
+    def _submit(self, func):
+        if self.server.down:
+            raise error(SERVER_DOWN, "Can't contact LDAP server")
+        self.msgid += 1
+        try:
+            result = func()
+        except LDAPError as e:
+            result = e
+        self.pending[self.msgid] = (time.perf_counter() + self.server.latency, result)
+        return self.msgid
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who='', cred=''):
+        self.server.ops['bind'] += 1
+        self._wait()
+
+    def whoami_s(self):
+        self.server.ops['whoami'] += 1
+        self._wait()
+        return 'dn:bluepages'
+
+    def unbind_s(self):
+        self.server.ops['unbind'] += 1
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None):
+        self.server.ops['search'] += 1
+        self._wait()
+        return self.server.search(base, scope, filterstr, attrlist)
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+            attrsonly=0, serverctrls=None, **kwargs):
+        self.server.ops['search'] += 1
+        page = None
+        sort = None
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == self.controls.SimplePagedResultsControl.controlType:
+                page = ctrl
+            elif ctrl.controlType == self.controls.sss.SSSRequestControl.controlType:
+                sort = ctrl.ordering_rules[0]
+
+        def search():
+            # the whole result set is worked out on the first page and then
+            # handed out a page at a time, as the cookie asks for it
+            if page is None:
+                return (self.server.search(base, scope, filterstr, attrlist, sort), [])
+            if page.cookie:
+                (results, start) = self.searches.pop(page.cookie)
+            else:
+                (results, start) = (self.server.search(base, scope, filterstr,
+                        attrlist, sort), 0)
+            end = start + min(page.size, self.server.max_page_size)
+            cookie = ''
+            if end < len(results):
+                cookie = f"{id(results)}:{end}"
+                self.searches[cookie] = (results, end)
+            control = self.controls.SimplePagedResultsControl(True,
+                    size=page.size, cookie=cookie)
+            return (results[start:end], [control])
+        return self._submit(search)
+
+    def result3(self, msgid, all=1, timeout=None):
+        (ready, result) = self.pending.pop(msgid)
+        self._wait(ready - time.perf_counter(), timeout)
+        if isinstance(result, LDAPError):
+            raise result
+        if result is None:
+            return (RES_ADD, [], msgid, [])
+        (data, controls) = result
+        return (RES_SEARCH_RESULT, data, msgid, controls)
+
+    def add_s(self, dn, modlist):
+        self.server.ops['add'] += 1
+        self._wait()
+        self.server.add(dn, dict(modlist))
+
+    def modify_s(self, dn, modlist):
+        self.server.ops['modify'] += 1
+        self._wait()
+        self.server.modify(dn, modlist)
+
+    def delete_s(self, dn):
+        self.server.ops['delete'] += 1
+        self._wait()
+        self.server.delete(dn)
+
+    def add_ext(self, dn, modlist, serverctrls=None):
+        self.server.ops['add'] += 1
+        return self._submit(lambda: self.server.add(dn, dict(modlist)) and None)
+
+    def modify_ext(self, dn, modlist, serverctrls=None):
+        self.server.ops['modify'] += 1
+        return self._submit(lambda: self.server.modify(dn, modlist))
+
+    def delete_ext(self, dn, serverctrls=None):
+        self.server.ops['delete'] += 1
+        return self._submit(lambda: self.server.delete(dn))
+
+
+# servers by uri, for initialize() to find
+SERVERS = {}
+
+
+def _fallback_modules():
+    """
+    Build stand-ins for the python-ldap modules, for when it isn't
+    installed. Only as much as bluepages uses is there.
+    """
+    ldap = types.ModuleType('ldap')
+    for (name, value) in list(globals().items()):
+        if name.isupper() or name in ('LDAPError', 'SERVER_DOWN',
+                'NO_SUCH_OBJECT', 'ALREADY_EXISTS', 'OTHER', 'TIMEOUT'):
+            setattr(ldap, name, value)
+    ldap.OPT_REFERRALS = 8
+    ldap.OPT_X_TLS_REQUIRE_CERT = 0x6006
+    ldap.OPT_X_TLS_NEVER = 0
+    ldap.set_option = lambda option, value: None
+
+    controls = types.ModuleType('ldap.controls')
+
+    class SimplePagedResultsControl:
+        controlType = '1.2.840.113556.1.4.319'
+
+        def __init__(self, criticality=True, size=10, cookie=''):
+            (self.criticality, self.size, self.cookie) = (criticality, size, cookie)
+
+    controls.SimplePagedResultsControl = SimplePagedResultsControl
+
+    sss = types.ModuleType('ldap.controls.sss')
+
+    class SSSRequestControl:
+        controlType = '1.2.840.113556.1.4.473'
+
+        def __init__(self, criticality=False, ordering_rules=None):
+            (self.criticality, self.ordering_rules) = (criticality, ordering_rules)
+
+    sss.SSSRequestControl = SSSRequestControl
+    controls.sss = sss
+
+    modlist = types.ModuleType('ldap.modlist')
+    modlist.addModlist = lambda entry, ignore_attr_types=None: [
+            (k, v) for (k, v) in entry.items() if v]
+
+    def modifyModlist(old, new, ignore_attr_types=None, ignore_oldexistent=0,
+            case_ignore_attr_types=None):
+        mods = []
+        old_names = {k.lower(): k for k in old}
+        case_ignore = {k.lower() for k in case_ignore_attr_types or ()}
+        for (name, values) in new.items():
+            old_values = old.get(old_names.get(name.lower()), [])
+            (a, b) = (set(old_values), set(values or []))
+            if name.lower() in case_ignore:
+                (a, b) = ({v.lower() for v in a}, {v.lower() for v in b})
+            if a != b:
+                if old_values:
+                    mods.append((MOD_DELETE, name, None))
+                if values:
+                    mods.append((MOD_ADD, name, values))
+        if not ignore_oldexistent:
+            new_names = {k.lower() for k in new}
+            mods.extend((MOD_DELETE, name, None) for name in old
+                    if name.lower() not in new_names)
+        return mods
+
+    modlist.modifyModlist = modifyModlist
+
+    dn = types.ModuleType('ldap.dn')
+    dn.str2dn = lambda s: [[tuple(rdn.split('=', 1)) + (1,)]
+            for rdn in s.split(',')]
+
+    filter = types.ModuleType('ldap.filter')
+    filter.escape_filter_chars = lambda s: "".join(
+            '\\%02x' % ord(c) if c in '\\*()\0' else c for c in s)
+
+    ldap.controls = controls
+    ldap.modlist = modlist
+    ldap.dn = dn
+    ldap.filter = filter
+    return {'ldap': ldap, 'ldap.controls': controls, 'ldap.controls.sss': sss,
+            'ldap.modlist': modlist, 'ldap.dn': dn, 'ldap.filter': filter}
+
+
+def install():
+    """
+    Make ldap.initialize() connect to the fake servers in SERVERS. If
+    python-ldap is installed only initialize is replaced, otherwise
+    stand-ins for the modules bluepages imports are put in sys.modules.
+    This has to be called before the bluepages modules are imported.
+    """
+    try:
+        import ldap
+        import ldap.controls
+        import ldap.controls.sss
+    except ImportError:
+        sys.modules.update(_fallback_modules())
+        import ldap
+
+    def initialize(uri, *args, **kwargs):
+        if uri not in SERVERS:
+            raise error(ldap.SERVER_DOWN, "Can't contact LDAP server", uri)
+        return Connection(SERVERS[uri], ldap.controls)
+
+    # the real exceptions are raised if python-ldap is installed, so the
+    # bluepages error handling sees what it would normally
+    for name in ('LDAPError', 'SERVER_DOWN', 'NO_SUCH_OBJECT', 'ALREADY_EXISTS', 'OTHER', 'TIMEOUT'):
+        globals()[name] = getattr(ldap, name)
+
+    ldap.initialize = initialize
+    return ldap
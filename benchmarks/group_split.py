@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+#
+# microbenchmark comparing the old group line splitting in exportbp with
+# bpfiles.split_group
+#
+
+import argparse
+import collections
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bpfiles
+
+
+def old_split(name, user_list, max_entry_length):
+    """The loop exportbp used to run, re-joining the slice for every member"""
+    s = 0
+    user_list_slices = collections.defaultdict(list)
+    for user in user_list:
+        if len(",".join(user_list_slices[s]))+len(user)+1 > max_entry_length:
+            s += 1
+        user_list_slices[s].append(user)
+
+    lines = []
+    for (i, users) in sorted(user_list_slices.items(), reverse=True):
+        lines.append((i and f"{name}_{i}" or name, users))
+    return lines
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - start:10.4f}s")
+    return result
+
+
+description="Benchmark splitting large groups into group file lines."
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('-m', '--members', type=int, nargs='+',
+        default=[1000, 10000, 100000],
+        help='group sizes to try (default: 1000 10000 100000)')
+parser.add_argument('-l', '--max-entry-length', type=int, default=924,
+        help='maximum length of the member list (default: 924)')
+args = parser.parse_args()
+
+random.seed(1)
+
+for members in args.members:
+    # usernames of 4-20 characters, like firstname.lastname ones
+    user_list = sorted(''.join(random.choices(string.ascii_lowercase,
+            k=random.randint(4, 20))) for i in range(members))
+
+    print(f"{members} members")
+    old = timed("  old re-join per member", lambda: old_split('research',
+            user_list, args.max_entry_length))
+    new = timed("  bpfiles.split_group", lambda: bpfiles.split_group('research',
+            user_list, args.max_entry_length))
+    assert old == new
+    print(f"  {len(new)} lines")
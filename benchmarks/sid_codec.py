@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+#
+# microbenchmark comparing the old SID decoding in syncbp with bpuid, after
+# checking both against some known SIDs
+#
+
+import argparse
+import configparser
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bpuid
+
+# SID strings and their binary form, written out by hand
+KNOWN = [
+    ('S-1-5-21-1004336348-1177238915-682003330-512',
+            '010500000000000515000000dcf4dc3b833d2b46828ba62800020000'),
+    ('S-1-5-21-3623811015-3361044348-30300820-4294967295',
+            '010500000000000515000000c7f7fed77c7755c8945ace01ffffffff'),
+    ('S-1-5-32-544', '01020000000000052000000020020000'),
+    ('S-1-5-18', '010100000000000512000000'),
+    ('S-1-1-0', '010100000000000100000000'),
+]
+
+
+def old_sid2string(binary):
+    """The sid2string syncbp used to have, one unpack per sub-authority"""
+    version = struct.unpack('B', binary[0:1])[0]
+    assert version == 1, version
+    length = struct.unpack('B', binary[1:2])[0]
+    authority = struct.unpack(b'>Q', b'\x00\x00' + binary[2:8])[0]
+    string = 'S-%d-%d' % (version, authority)
+    binary = binary[8:]
+    assert len(binary) == 4 * length
+    for i in range(length):
+        value = struct.unpack('<L', binary[4*i:4*(i+1)])[0]
+        string += '-%d' % value
+    return string
+
+
+def old_sid2uid(sid, config):
+    """The sid2uid syncbp used to have, re-parsing the string form"""
+    rid = old_sid2string(sid).split('-')[7]
+    offset = int(config.get('directory', 'sid_offset', fallback=200000))
+    return offset + int(rid)
+
+
+def check():
+    for (text, hex) in KNOWN:
+        binary = bytes.fromhex(hex)
+        assert bpuid.sid2string(binary) == text, text
+        assert old_sid2string(binary) == text, text
+        assert bpuid.string2sid(text) == binary, text
+        assert bpuid.sid_rid(binary) == int(text.split('-')[-1]), text
+
+    for bad in (b'', b'\x01\x05', bytes.fromhex(KNOWN[0][1])[:-1],
+            b'\x02' + bytes.fromhex(KNOWN[0][1])[1:]):
+        try:
+            bpuid.sid_rid(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad.hex()} was accepted")
+
+    # the RID is the last sub-authority however many there are (the old
+    # sid2uid took the 5th, which is only right for domain SIDs with
+    # exactly five)
+    sids = [bytes.fromhex(hex) for (text, hex) in KNOWN]
+    assert bpuid.SIDMapper(100000).uids(sids) == \
+            [100000 + int(text.split('-')[-1]) for (text, hex) in KNOWN]
+    assert bpuid.SIDMapper(100000).uids([]) == []
+    print(f"{len(KNOWN)} known SIDs round trip")
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - start:10.4f}s")
+    return result
+
+
+description="Benchmark decoding SIDs and mapping them to UIDs."
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('-n', '--sids', type=int, default=100000,
+        help='number of SIDs to decode (default: 100000)')
+parser.add_argument('--page-size', type=int, default=1000,
+        help='number of SIDs passed to each SIDMapper.uids call (default: 1000)')
+args = parser.parse_args()
+
+check()
+
+random.seed(1)
+domain = 'S-1-5-21-1004336348-1177238915-682003330'
+sids = [bpuid.string2sid(f"{domain}-{rid}")
+        for rid in random.sample(range(1000, 2 ** 30), args.sids)]
+config = configparser.ConfigParser()
+config.read_dict({'directory': {'sid_offset': '100000000'}})
+mapper = bpuid.SIDMapper.from_config(config)
+
+print(f"{args.sids} SIDs")
+old = timed("old sid2string", lambda: [old_sid2string(s) for s in sids])
+new = timed("bpuid.sid2string", lambda: [bpuid.sid2string(s) for s in sids])
+assert old == new
+
+old = timed("old sid2uid (config read per call)",
+        lambda: [old_sid2uid(s, config) for s in sids])
+new = timed("bpuid.SIDMapper.uid", lambda: [mapper.uid(s) for s in sids])
+assert old == new
+new = timed(f"bpuid.SIDMapper.uids, pages of {args.page_size}",
+        lambda: [uid for i in range(0, len(sids), args.page_size)
+            for uid in mapper.uids(sids[i:i + args.page_size])])
+assert old == new
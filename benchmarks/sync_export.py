@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+#
+# benchmark syncbp and exportbp end to end against fake AD and ldap servers
+#
+
+import argparse
+import collections
+import configparser
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fakeldap
+fakeldap.install()
+
+import bpldap
+import exportbp
+import syncbp
+
+BASE = 'DC=example,DC=com'
+USERS_OU = f'OU=Users,{BASE}'
+GROUPS_OU = f'OU=Groups,{BASE}'
+AD_URI = 'ldap://dc01.example.com'
+LDAP_URI = 'ldap://ldap.example.com'
+
+
+def make_sid(rid):
+    """A binary domain SID ending in rid"""
+    return struct.pack('<BB', 1, 5) + (5).to_bytes(6, 'big') + \
+            struct.pack('<5L', 21, 1111, 2222, 3333, rid)
+
+
+def make_rids(count, distribution):
+    """
+    RIDs for count users. sequential is a freshly built domain, random is
+    spread over the whole RID space and clustered is blocks of consecutive
+    RIDs with gaps between them, like a domain that has been migrated into.
+    """
+    if distribution == 'sequential':
+        return [1000 + i for i in range(count)]
+    if distribution == 'random':
+        return random.sample(range(1000, 2 ** 30), count)
+    rids = []
+    start = 1000
+    while len(rids) < count:
+        rids.extend(range(start, start + 1000))
+        start += 1000 + random.randint(1, 100000)
+    return rids[:count]
+
+
+def add_user(server, i, rid):
+    name = f"user{i:06d}"
+    dn = f"CN=User {i},{USERS_OU}"
+    (given, sn) = (f"First{i}", f"Last{i}")
+    server.add(dn, {'objectClass': [b'top', b'person', b'organizationalPerson', b'user'],
+            'objectCategory': [b'person'], 'sAMAccountName': [name.encode()],
+            'displayName': [f"{given} {sn}".encode()], 'givenName': [given.encode()],
+            'sn': [sn.encode()], 'objectSid': [make_sid(rid)]})
+    return dn
+
+
+def make_directory(server, users, leaves, depth, distribution):
+    """
+    Fill a fake AD with users spread over `leaves` groups, which are nested
+    `depth` levels deep (four to a group) under a top level group. One user
+    in ten is in a second group as well. Returns the DNs of the top group,
+    the leaf groups and the users.
+    """
+    rids = make_rids(users, distribution)
+    user_dns = [add_user(server, i, rid) for (i, rid) in enumerate(rids)]
+
+    members = collections.defaultdict(list)
+    for (i, dn) in enumerate(user_dns):
+        members[i % leaves].append(dn)
+        if i % 10 == 0:
+            members[(i + 1) % leaves].append(dn)
+
+    leaf_dns = []
+    for leaf in range(leaves):
+        dn = f"CN=team{leaf},{GROUPS_OU}"
+        server.add(dn, {'objectClass': [b'top', b'group'], 'cn': [f"team{leaf}".encode()],
+                'member': [m.encode() for m in members[leaf]]})
+        leaf_dns.append(dn)
+
+    level = leaf_dns
+    for d in range(depth):
+        parents = []
+        for i in range(0, len(level), 4):
+            dn = f"CN=level{d}-{i // 4},{GROUPS_OU}"
+            server.add(dn, {'objectClass': [b'top', b'group'],
+                    'member': [m.encode() for m in level[i:i + 4]]})
+            parents.append(dn)
+        level = parents
+
+    top = f"CN=bp-users,{GROUPS_OU}"
+    server.add(top, {'objectClass': [b'top', b'group'],
+            'member': [m.encode() for m in level]})
+    return (top, leaf_dns, user_dns)
+
+
+def churn(server, leaf_dns, user_dns, fraction, first_new):
+    """Take a fraction of the users out of their groups and add as many new ones"""
+    count = int(len(user_dns) * fraction)
+    leaving = set(random.sample(user_dns, count))
+    for dn in leaf_dns:
+        group = server.entries[dn.lower()]
+        old = group.values('member')
+        new = [m for m in old if m not in leaving]
+        if len(new) != len(old):
+            server.modify(dn, [(fakeldap.MOD_REPLACE, 'member', [m.encode() for m in new])])
+
+    joining = collections.defaultdict(list)
+    for i in range(count):
+        dn = add_user(server, first_new + i, 2 ** 30 + first_new + i)
+        joining[leaf_dns[i % len(leaf_dns)]].append(dn.encode())
+    for (group, dns) in joining.items():
+        server.modify(group, [(fakeldap.MOD_ADD, 'member', dns)])
+
+
+def make_config(workdir, top, leaf_dns, config_groups, page_size, expand):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'global': {'db': os.path.join(workdir, 'bp.db'), 'journal_mode': 'wal'},
+        'directory': {'dc': AD_URI[len('ldap://'):], 'dn': BASE, 'binduser': 'bp',
+            'bindpw': 'x', 'sid_offset': '100000', 'page_size': str(page_size),
+            'expand_groups': expand},
+        'ldap': {'uri': LDAP_URI, 'binddn': 'cn=admin', 'bindpw': 'x',
+            'users_ou': 'ou=People,dc=example,dc=com',
+            'groups_ou': 'ou=Group,dc=example,dc=com', 'page_size': str(page_size)},
+        'group:users': {'name': 'users', 'gid': '5000', 'dn': top,
+            'provisioning': 'yes'},
+    })
+    for (i, dn) in enumerate(leaf_dns[:config_groups]):
+        config.read_dict({f"group:team{i}": {'name': f"team{i}",
+                'gid': str(5001 + i), 'dn': dn}})
+
+    # the NIS maps need the gdbm module, so are only built if it is there
+    try:
+        import dbm.gnu
+    except ImportError:
+        pass
+    else:
+        maps_dir = os.path.join(workdir, 'maps')
+        os.mkdir(maps_dir)
+        config.read_dict({'nis': {'maps_dir': maps_dir,
+                'master': 'nis01.example.com'}})
+    return config
+
+
+def snapshot(workdir):
+    """The content of everything an export writes, ie all but the database"""
+    files = {}
+    for (path, dirs, names) in os.walk(workdir):
+        for name in names:
+            if not name.startswith('bp.db'):
+                with open(os.path.join(path, name), 'rb') as f:
+                    files[os.path.join(path, name)] = f.read()
+    return files
+
+
+class Phases:
+    """
+    Measures each phase of a benchmark run: the wall time, the operations
+    asked of each fake server, the sqlite statements run and the peak RSS
+    of the process by the end of the phase.
+    """
+
+    def __init__(self, servers, con):
+        self.servers = servers
+        self.statements = 0
+        self.results = []
+        con.set_trace_callback(self._statement)
+
+    def _statement(self, sql):
+        self.statements += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        ops = {label: collections.Counter(server.ops)
+                for (label, server) in self.servers.items()}
+        statements = self.statements
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+        result = {'phase': name, 'seconds': time.perf_counter() - start,
+                'sql': self.statements - statements,
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        for (label, server) in self.servers.items():
+            result[label] = dict(server.ops - ops[label])
+        self.results.append(result)
+
+
+def run(users, args):
+    random.seed(args.seed)
+    fakeldap.SERVERS.clear()
+    ad = fakeldap.SERVERS[AD_URI] = fakeldap.Server(args.latency)
+    ldap_server = fakeldap.SERVERS[LDAP_URI] = fakeldap.Server(args.latency)
+
+    build_start = time.perf_counter()
+    (top, leaf_dns, user_dns) = make_directory(ad, users, args.groups,
+            args.depth, args.sids)
+    ad.ops.clear()
+    print(f"{users} users, {args.groups} groups {args.depth} deep, {args.sids} SIDs, "
+            f"{args.expand} group expansion, {args.latency * 1000:g}ms latency "
+            f"(directory built in {time.perf_counter() - build_start:.1f}s)")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config = make_config(workdir, top, leaf_dns, args.config_groups,
+                args.page_size, args.expand)
+        passwd = os.path.join(workdir, 'passwd')
+        group = os.path.join(workdir, 'group')
+        con = sqlite3.connect(config['global']['db'])
+        phases = Phases({'ad': ad, 'ldap': ldap_server}, con)
+
+        with phases.phase("initial sync"):
+            directory = syncbp.connect(config)
+            syncbp.sync(config, con, directory, incremental=args.incremental)
+        with phases.phase("initial export"):
+            target = exportbp.connect(config)
+            exportbp.export(config, con, target, passwd, group, stream=args.stream)
+
+        with phases.phase("sync, no changes"):
+            syncbp.sync(config, con, directory, incremental=args.incremental)
+        with phases.phase("export, no changes"):
+            exportbp.export(config, con, target, passwd, group, stream=args.stream)
+
+        churn(ad, leaf_dns, user_dns, args.churn, users)
+        ad.ops.clear()
+
+        with phases.phase(f"sync, {args.churn:.0%} churn"):
+            (changes, metrics) = syncbp.sync(config, con, directory,
+                    incremental=args.incremental)
+        # the LDIF modes are offline, they mustn't touch the files or maps
+        before = snapshot(workdir)
+        with phases.phase("ldif"), open(os.devnull, 'w') as f:
+            exportbp.export(config, con, None, passwd, group,
+                    ldif=bpldap.LDIFWriter(f, changes=False))
+        with phases.phase("ldif delta"), open(os.devnull, 'w') as f:
+            exportbp.export(config, con, target, passwd, group,
+                    stream=args.stream, ldif=bpldap.LDIFWriter(f))
+        assert snapshot(workdir) == before, "an LDIF export changed the files"
+
+        with phases.phase("export changes only"):
+            exportbp.export(config, con, target, passwd, group,
+                    stream=args.stream, changes=changes)
+
+        con.close()
+
+    print(f"{'phase':<22} {'seconds':>9} {'ad ops':>24} {'ldap ops':>32} "
+            f"{'sql':>9} {'peak MB':>8}")
+    for r in phases.results:
+        (ad_ops, ldap_ops) = [" ".join(f"{k}={v}" for (k, v) in sorted(r[label].items()))
+                for label in ('ad', 'ldap')]
+        print(f"{r['phase']:<22} {r['seconds']:9.3f} {ad_ops:>24} {ldap_ops:>32} "
+                f"{r['sql']:9d} {r['peak_rss_mb']:8.1f}")
+    print()
+    return {'users': users, 'phases': phases.results}
+
+
+def child(users, args, queue):
+    # always put something on the queue, so a failed run doesn't leave the
+    # parent waiting forever
+    result = None
+    try:
+        result = run(users, args)
+    finally:
+        queue.put(result)
+
+
+description="Benchmark syncbp and exportbp against fake AD and ldap servers."
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('-u', '--users', type=int, nargs='+', default=[1000, 10000],
+        help='directory sizes to try, each is run in its own process so the '
+        'peak RSS is its own (default: 1000 10000, up to 500000 is sensible)')
+parser.add_argument('-g', '--groups', type=int, default=20,
+        help='number of leaf groups the users are spread over (default: 20)')
+parser.add_argument('--depth', type=int, default=2,
+        help='levels of nesting between the leaf groups and the provisioning '
+        'group (default: 2)')
+parser.add_argument('--config-groups', type=int, default=5,
+        help='number of leaf groups also configured as bluepages groups (default: 5)')
+parser.add_argument('--sids', choices=['sequential', 'random', 'clustered'],
+        default='sequential', help='how the user RIDs are distributed')
+parser.add_argument('-l', '--latency', type=float, default=0.0,
+        help='seconds each request to the fake servers takes (default: 0)')
+parser.add_argument('--churn', type=float, default=0.01,
+        help='fraction of users who leave and join before the last sync (default: 0.01)')
+parser.add_argument('--page-size', type=int, default=1000)
+parser.add_argument('-i', '--incremental', action="store_true",
+        help='use incremental syncs')
+parser.add_argument('--expand', choices=['server', 'local', 'check'],
+        default='server', help='how syncbp expands nested groups (the '
+        'expand_groups setting), check warns if local and server differ')
+parser.add_argument('--stream', action="store_true", help='use streaming exports')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--json', metavar="FILE",
+        help='also write the results to FILE as json, to compare runs')
+args = parser.parse_args()
+
+results = []
+context = multiprocessing.get_context('fork')
+for users in args.users:
+    queue = context.Queue()
+    process = context.Process(target=child, args=(users, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if result is None:
+        sys.exit(1)
+    results.append(result)
+
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump(results, f, indent=2)
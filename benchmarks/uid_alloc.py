@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+#
+# microbenchmark comparing the old linear scan UID checks with bpuid
+#
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bpuid
+
+
+def is_unique_uid(uid, users):
+    """The linear scan syncbp used to do for every candidate UID"""
+    for user in users.values():
+        if user['UID'] == str(uid):
+            return False
+    return True
+
+
+def pick_uid(cur, start):
+    """The SELECT per candidate UID updatebp used to do"""
+    uid = start
+    while cur.execute("select UID from passwd where uid = ?", (uid, )).fetchone():
+        uid += 1
+    return uid
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - start:10.4f}s")
+    return result
+
+
+description="Benchmark UID allocation against a synthetic user database."
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('-u', '--users', type=int, default=100000,
+        help='number of existing users (default: 100000)')
+parser.add_argument('-n', '--new', type=int, default=200,
+        help='number of new users to allocate UIDs for (default: 200)')
+parser.add_argument('--manual', type=int, default=500,
+        help='number of users already in the manual range (default: 500)')
+args = parser.parse_args()
+
+offset = 100000000
+slice = 200000
+random.seed(1)
+
+# existing domain users, plus a block of users at the start of the manual
+# range so pick_uid has to step over them
+rids = random.sample(range(1000, 1000 + args.users * 2), args.users)
+users = {f"user{i}": {'UID': str(offset + rid)} for (i, rid) in enumerate(rids)}
+for i in range(args.manual):
+    users[f"manual{i}"] = {'UID': str(offset - slice + 1 + i)}
+
+# half the new users collide with an existing UID in the first slice
+new_rids = rids[:args.new // 2] + [r + args.users * 2 for r in range(args.new - args.new // 2)]
+
+print(f"{len(users)} existing users, {args.new} new users")
+
+
+def old_sync():
+    taken = dict(users)
+    for (i, rid) in enumerate(new_rids):
+        uid = offset + rid
+        while not is_unique_uid(uid, taken):
+            uid += slice
+        taken[f"new{i}"] = {'UID': str(uid)}
+    return [taken[f"new{i}"]['UID'] for i in range(len(new_rids))]
+
+
+def new_sync():
+    uids = bpuid.UIDAllocator(user['UID'] for user in users.values())
+    return [str(uids.allocate(offset + rid, slice)) for rid in new_rids]
+
+
+old = timed("syncbp is_unique_uid linear scan", old_sync)
+new = timed("syncbp bpuid.UIDAllocator.allocate", new_sync)
+assert old == new
+
+con = sqlite3.connect(':memory:')
+cur = con.cursor()
+cur.execute("CREATE TABLE passwd (name text, UID text)")
+cur.executemany("INSERT INTO passwd VALUES (?, ?)",
+        [(name, user['UID']) for (name, user) in users.items()])
+
+old = timed("updatebp pick_uid SELECT per candidate",
+        lambda: pick_uid(cur, offset - slice + 1))
+new = timed("updatebp bpuid first_free (incl. load)",
+        lambda: bpuid.UIDAllocator.from_db(cur).first_free(offset - slice + 1))
+assert old == new
+
+uids = bpuid.UIDAllocator.from_db(cur)
+timed("bpuid first_free x 10000 (loaded)",
+        lambda: [uids.first_free(offset - slice + 1) for i in range(10000)])
@@ -0,0 +1,304 @@
+#
+# sqlite database helpers shared by the bluepages scripts
+#
+
+import hashlib
+import json
+import sqlite3
+
+# the columns of the passwd table, in order
+PASSWD_COLUMNS = ('name', 'sAMAccountName', 'password', 'UID', 'GID', 'GECOS',
+        'directory', 'shell', 'status', 'givenName', 'sn', 'source')
+
+
+def create_tables(cur):
+    """
+    Create the tables as they were before the schema had a version (the
+    first migration), with everything stored as text
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS passwd
+            (name text NOT NULL PRIMARY KEY,
+                sAMAccountName text NOT NULL UNIQUE,
+                password text, UID text, GID text, GECOS text,
+                directory text, shell text, status text,
+                givenName text, sn text)""")
+    cur.execute("CREATE INDEX IF NOT EXISTS passwd_status ON passwd (status)")
+    create_group_tables(cur)
+    create_sync_state_table(cur)
+
+
+def integer_ids(cur):
+    """
+    Store UIDs and GIDs as integers, with a unique index on UID and an
+    index on GID. Any UIDs or GIDs which aren't numbers, or users sharing
+    a UID, have to be fixed (eg with updatebp.py) first.
+    """
+    for (table, column) in (('passwd', 'UID'), ('passwd', 'GID'), ('grp', 'GID')):
+        bad = [r[0] for r in cur.execute(f"""select name from {table}
+            where {column} = '' or {column} GLOB '*[^0-9]*'""")]
+        if bad:
+            raise ValueError(f"{column} is not a number for " + ", ".join(bad))
+    shared = [r[0] for r in cur.execute("""select group_concat(name, ', ')
+        from passwd where UID is not null
+        group by CAST(UID AS INTEGER) having count(*) > 1""")]
+    if shared:
+        raise ValueError("users share a UID: " + "; ".join(shared))
+
+    # the columns the table had at this point, later steps add more
+    names = ('name', 'sAMAccountName', 'password', 'UID', 'GID', 'GECOS',
+            'directory', 'shell', 'status', 'givenName', 'sn')
+    columns = ", ".join(f"CAST({c} AS INTEGER)" if c in ('UID', 'GID') else c
+            for c in names)
+    cur.execute("""CREATE TABLE passwd_new
+            (name text NOT NULL PRIMARY KEY,
+                sAMAccountName text NOT NULL UNIQUE,
+                password text, UID integer, GID integer, GECOS text,
+                directory text, shell text, status text,
+                givenName text, sn text)""")
+    cur.execute(f"""INSERT INTO passwd_new ({", ".join(names)})
+        SELECT {columns} FROM passwd""")
+    cur.execute("DROP TABLE passwd")
+    cur.execute("ALTER TABLE passwd_new RENAME TO passwd")
+    cur.execute("CREATE INDEX passwd_status ON passwd (status)")
+    cur.execute("CREATE UNIQUE INDEX passwd_uid ON passwd (UID)")
+    cur.execute("CREATE INDEX passwd_gid ON passwd (GID)")
+
+    cur.execute("""CREATE TABLE grp_new
+        (name text NOT NULL PRIMARY KEY, GID integer)""")
+    cur.execute("INSERT INTO grp_new SELECT name, CAST(GID AS INTEGER) FROM grp")
+    cur.execute("DROP TABLE grp")
+    cur.execute("ALTER TABLE grp_new RENAME TO grp")
+
+
+def user_sources(cur):
+    """
+    Record which directory each synced user was found in (the source
+    column), so the same one keeps the account name in every sync. It is
+    NULL for users who didn't come from a sync, or were synced before it
+    was recorded, until a sync finds them. The saved USNs are dropped so
+    the next sync is a full one, which fills it in for everyone it finds.
+    """
+    cur.execute("ALTER TABLE passwd ADD COLUMN source text")
+    cur.execute("DELETE FROM sync_state WHERE key LIKE '%highestCommittedUSN'")
+
+
+# the steps to bring the schema up to date. the database's user_version is
+# the number of them which have been run, so new steps go on the end.
+MIGRATIONS = [create_tables, integer_ids, user_sources]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def upgrade(cur):
+    """
+    Bring the database schema up to date, creating the tables if they don't
+    exist. Each migration step which hasn't been run is, in its own
+    transaction along with the user_version it brings the database to, so
+    a step which fails leaves the database as it was.
+
+    Raises ValueError if a step can't be run (it says why) or the database
+    is from a newer version of bluepages.
+    """
+    con = cur.connection
+    while True:
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"The database schema is version {version}, "
+                    f"newer than this version of bluepages ({SCHEMA_VERSION})")
+        if version == SCHEMA_VERSION:
+            return
+
+        con.commit()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have run the step while we waited
+            version = cur.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                MIGRATIONS[version](cur)
+                cur.execute(f"PRAGMA user_version = {version + 1}")
+        except Exception as e:
+            con.rollback()
+            if isinstance(e, ValueError):
+                raise ValueError(f"Could not upgrade the database schema "
+                        f"to version {version + 1}: {e}") from e
+            raise
+        con.commit()
+
+
+def get_user(cur, name):
+    """Return the passwd row of the named user as a dict, or None"""
+    r = cur.execute("select * from passwd where name = ?", (name,)).fetchone()
+    if r is None:
+        return None
+    return dict(zip([c[0] for c in cur.description], r))
+
+
+def get_users(cur):
+    """Return every passwd row as a dict, keyed by the linux username"""
+    rows = cur.execute("select * from passwd").fetchall()
+    columns = [c[0] for c in cur.description]
+    users = (dict(zip(columns, r)) for r in rows)
+    return {user['name']: user for user in users}
+
+
+def insert_users(cur, users, update=()):
+    """
+    Add passwd rows (dicts with each of PASSWD_COLUMNS). If update names
+    some of the columns then a user who is already there has just those
+    updated instead.
+    """
+    sql = f"""INSERT INTO passwd ({", ".join(PASSWD_COLUMNS)})
+        values ({", ".join("?" * len(PASSWD_COLUMNS))})"""
+    if update:
+        sql += " ON CONFLICT (name) DO UPDATE SET " + ", ".join(
+                f"{column} = excluded.{column}" for column in update)
+    cur.executemany(sql, ([user[column] for column in PASSWD_COLUMNS]
+            for user in users))
+
+
+def delete_users(cur, names):
+    """Remove the named users from the passwd table"""
+    cur.executemany("DELETE FROM passwd WHERE name = ?",
+            [(name,) for name in names])
+
+
+def create_group_tables(cur):
+    """
+    Create the grp and group_member tables if they don't exist.
+
+    Older versions stored the members of each group as a json list in
+    grp.user_list, which was dropped and rebuilt on every sync. If we find
+    one of those the members are moved into group_member and the column
+    removed.
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS grp
+        (name text NOT NULL PRIMARY KEY, GID text)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS group_member
+        (grp text NOT NULL, sAMAccountName text NOT NULL,
+            PRIMARY KEY (grp, sAMAccountName))""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS group_member_sAMAccountName
+        ON group_member (sAMAccountName)""")
+
+    columns = [r[1] for r in cur.execute("PRAGMA table_info(grp)")]
+    if 'user_list' not in columns:
+        return
+
+    for (name, user_list) in cur.execute("select name, user_list from grp").fetchall():
+        cur.executemany("INSERT OR IGNORE INTO group_member VALUES (?, ?)",
+                [(name, member) for member in json.loads(user_list or '[]')])
+
+    cur.execute("""CREATE TABLE grp_new
+        (name text NOT NULL PRIMARY KEY, GID text)""")
+    cur.execute("INSERT INTO grp_new SELECT name, GID FROM grp")
+    cur.execute("DROP TABLE grp")
+    cur.execute("ALTER TABLE grp_new RENAME TO grp")
+
+
+def group_member_changes(cur, name, members):
+    """
+    Compare the stored members of the named group with the given list,
+    returning the sets of members which would be added and removed to make
+    them match.
+    """
+    old = {r[0] for r in cur.execute(
+            "select sAMAccountName from group_member where grp = ?", (name,))}
+    new = set(members)
+    return (new - old, old - new)
+
+
+def update_group_members(cur, name, added, removed):
+    """Add and remove members of the named group, as found by group_member_changes()"""
+    cur.executemany("DELETE FROM group_member WHERE grp = ? AND sAMAccountName = ?",
+            [(name, member) for member in removed])
+    cur.executemany("INSERT INTO group_member VALUES (?, ?)",
+            [(name, member) for member in added])
+
+
+def stale_groups(cur, keep):
+    """Return the names of the groups in the database which aren't in keep"""
+    return [r[0] for r in cur.execute("select name from grp") if r[0] not in keep]
+
+
+def remove_groups(cur, names):
+    """Remove the named groups and their members"""
+    for name in names:
+        cur.execute("DELETE FROM group_member WHERE grp = ?", (name,))
+        cur.execute("DELETE FROM grp WHERE name = ?", (name,))
+
+
+def fingerprint(cur):
+    """
+    Return a hash of the users, groups and group members in the database,
+    so a plan made from it can tell if it has changed since
+    """
+    digest = hashlib.sha256()
+    for query in ("select * from passwd order by name",
+            "select * from grp order by name",
+            "select * from group_member order by grp, sAMAccountName"):
+        try:
+            rows = cur.execute(query)
+        except sqlite3.OperationalError:
+            # the table doesn't exist yet
+            rows = []
+        for row in rows:
+            digest.update(json.dumps(row).encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def create_sync_state_table(cur):
+    """
+    Create the sync_state table if it doesn't exist, and return what is in
+    it as a dict. It holds the directory high-water mark from the last sync
+    along with whether there are changes waiting to be exported.
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS sync_state
+        (key text NOT NULL PRIMARY KEY, value text)""")
+    return dict(cur.execute("select key, value from sync_state").fetchall())
+
+
+def set_export_pending(cur, pending=True):
+    """
+    Record whether the database has changes which haven't been exported
+    yet. Anything which changes the database outside of a sync should set
+    this, so that the next export is a full one rather than only covering
+    the changes made by the sync.
+    """
+    create_sync_state_table(cur)
+    cur.execute("INSERT OR REPLACE INTO sync_state VALUES ('export_pending', ?)",
+            (pending and '1' or '0',))
+
+
+class ChangeSet:
+    """
+    The changes made to the database by a sync, so that an export can
+    update only the entries which are affected.
+
+    users is the set of sAMAccountNames of users who were added or became
+    active or inactive, groups the set of names of groups which were
+    added, removed or had their GID or members change. If rebuild is set
+    there were changes from before the sync which haven't been exported,
+    so everything needs to be.
+    """
+
+    def __init__(self):
+        self.users = set()
+        self.groups = set()
+        self.rebuild = False
+
+    def __bool__(self):
+        return bool(self.users or self.groups or self.rebuild)
+
+
+def set_pragmas(cur, journal_mode='wal'):
+    """
+    Tune the sqlite connection for our use. In WAL mode a commit only has
+    to sync the log rather than the whole database, and with
+    synchronous=NORMAL the sync only happens at checkpoints. A crash can
+    lose the last transaction but never corrupt the database, and a lost
+    sync is just picked up again by the next run from cron.
+
+    WAL needs shared memory so doesn't work with the database on a network
+    filesystem, set journal_mode = delete in [global] if that's the case.
+    """
+    cur.execute(f"PRAGMA journal_mode = {journal_mode}")
+    cur.execute("PRAGMA synchronous = NORMAL")
@@ -0,0 +1,367 @@
+#
+# helpers for writing the flat files exported by bluepages
+#
+
+import difflib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+class AtomicFile:
+    """
+    A file which is written to a temporary file alongside the real one and
+    only renamed into place if its content differs from what is already
+    there. Readers never see a half written file, and an unchanged file
+    keeps its modification time so anything built from it (eg the NIS maps)
+    doesn't need to be rebuilt.
+
+    Use it as a context manager in place of open(path, 'w'). Once closed
+    `changed` says whether the file was replaced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.changed = False
+        self.hash = hashlib.sha256()
+        (fd, self.tmp) = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.",
+                dir=os.path.dirname(os.path.abspath(path)))
+        self.f = os.fdopen(fd, 'w', encoding='utf-8')
+
+    def write(self, data):
+        self.hash.update(data.encode())
+        return self.f.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.f.close()
+        if exc_type:
+            os.unlink(self.tmp)
+            return False
+
+        if file_hash(self.path) == self.hash.hexdigest():
+            os.unlink(self.tmp)
+            return False
+
+        # keep the permissions of the file we are replacing
+        if os.path.exists(self.path):
+            os.chmod(self.tmp, os.stat(self.path).st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self.tmp, 0o666 & ~umask)
+
+        with open(self.tmp) as f:
+            os.fsync(f.fileno())
+        os.replace(self.tmp, self.path)
+        self.changed = True
+        return False
+
+
+def file_hash(path):
+    """Return the sha256 of a file, or None if it doesn't exist"""
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                h.update(block)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+class NssCacheFile(AtomicFile):
+    """
+    A file in the libnss-cache format, which is a passwd or group file with
+    an index file for each of the given fields (a dict of index name to the
+    colon separated field number), eg passwd.cache.ixname.
+
+    Each line of an index file is the key, a NUL, the byte offset of the
+    entry in the cache file and then NULs padding every line to the same
+    length (in bytes). The lines are sorted by key so that libnss-cache can binary
+    search them.
+    """
+
+    def __init__(self, path, indexes):
+        super().__init__(path)
+        self.indexes = {name: {} for name in indexes}
+        self.fields = indexes
+        self.offset = 0
+        self.partial = ''
+
+    def write(self, data):
+        # keep track of where each line starts so it can be indexed
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            fields = line.split(':')
+            for (name, field) in self.fields.items():
+                self.indexes[name][fields[field]] = self.offset
+            self.offset += len(line.encode()) + 1
+        return super().write(data)
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if exc_type:
+            return False
+
+        for (name, index) in self.indexes.items():
+            with AtomicFile(f"{self.path}.ix{name}") as f:
+                if not index:
+                    continue
+                key_length = max(len(key.encode()) for key in index)
+                pos_length = max(len(str(pos)) for pos in index.values())
+                for key in sorted(index):
+                    pos = str(index[key])
+                    padding = '\0' * (key_length + pos_length - len(key.encode()) - len(pos))
+                    f.write(f"{key}\0{pos}\0{padding}\n")
+        return False
+
+
+class TeeFile:
+    """Write the same data to several files at once"""
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+    def __enter__(self):
+        for f in self.files:
+            f.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for f in self.files:
+            f.__exit__(exc_type, exc, tb)
+        return False
+
+
+class NullFile:
+    """
+    Stands in for an AtomicFile when the files aren't to be touched at all,
+    eg when the ldap entries are only being written out as LDIF
+    """
+
+    changed = False
+
+    def write(self, data):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class PlanFile:
+    """
+    Stands in for an AtomicFile when working out a plan: what would be
+    written is kept rather than written, along with the hash of the file
+    as it is now so the plan can tell if it has changed before it is
+    applied. Once closed `changed` says whether the file would be replaced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.changed = False
+        self.hash = hashlib.sha256()
+        self.old_hash = file_hash(path)
+        self.parts = []
+
+    def write(self, data):
+        self.hash.update(data.encode())
+        self.parts.append(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.changed = self.hash.hexdigest() != self.old_hash
+        return False
+
+    def content(self):
+        return "".join(self.parts)
+
+    def diff(self):
+        """Return a unified diff of the file as it is and as it would be"""
+        if not self.changed:
+            return ""
+        old = []
+        if self.old_hash:
+            with open(self.path, encoding='utf-8', errors='replace') as f:
+                old = f.readlines()
+        return "".join(difflib.unified_diff(old,
+                self.content().splitlines(keepends=True), self.path,
+                f"{self.path} (planned)"))
+
+    def summary(self):
+        """Return the file as a dict for a plan"""
+        return {'path': self.path, 'old_hash': self.old_hash,
+                'changed': self.changed, 'diff': self.diff(),
+                'content': self.content()}
+
+
+def split_members(members, max_length):
+    """
+    Split a group's members up into slices which are no more than
+    max_length characters long when joined with commas, yielding each one
+    as it fills up. A running total of the length is kept so each member is
+    only looked at once. A member whose name is longer than max_length
+    still gets a slice to itself.
+    """
+    members_slice = []
+    # there is no comma before the first member
+    length = -1
+    for member in members:
+        if members_slice and length + len(member) + 1 > max_length:
+            yield members_slice
+            members_slice = []
+            length = -1
+        members_slice.append(member)
+        length += len(member) + 1
+    yield members_slice
+
+
+def split_group(name, members, max_length):
+    """
+    Return a list of (name, members) for a group split into slices of at
+    most max_length characters. Slices after the first are named name_1,
+    name_2 and so on, and are listed in descending order so that the 'real'
+    group comes last.
+    """
+    slices = list(enumerate(split_members(members, max_length)))
+    return [(i and f"{name}_{i}" or name, members_slice)
+            for (i, members_slice) in reversed(slices)]
+
+
+# the NIS maps we can build, along with the flat file they are built from
+# and the (colon separated) field of each line which is used as the key
+NIS_MAPS = {
+    'passwd.byname': ('passwd', 0),
+    'passwd.byuid': ('passwd', 2),
+    'group.byname': ('group', 0),
+    'group.bygid': ('group', 2),
+}
+
+
+def read_nis_map(path, field):
+    """
+    Return a dict of the entries for a NIS map built from a flat file. As
+    with makedbm if two lines have the same key the last one wins, which
+    means for a split group the gid maps to the 'real' group.
+    """
+    entries = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            entries[line.split(':')[field].encode()] = line.encode()
+    return entries
+
+
+def update_nis_map(path, entries, master):
+    """
+    Make the gdbm NIS map at path (as makedbm would build it) hold the given
+    entries, along with the YP_LAST_MODIFIED and YP_MASTER_NAME keys.
+
+    If the map already exists only the keys which have changed are written,
+    to a copy of the map which is then renamed over it, so ypserv never
+    sees a map half way through being updated. Returns True if the map was
+    changed.
+    """
+    import dbm.gnu
+
+    stale = []
+    changed = entries
+    if os.path.exists(path):
+        db = dbm.gnu.open(path, 'r')
+        try:
+            stale = [k for k in db.keys()
+                    if not k.startswith(b'YP_') and k not in entries]
+            changed = {k: v for (k, v) in entries.items()
+                    if k not in db or db[k] != v}
+        finally:
+            db.close()
+
+        if not stale and not changed:
+            return False
+
+    # the copy gets a name of its own, so two runs updating the map at the
+    # same time can't write to the same file
+    (fd, tmp) = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.",
+            dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        if os.path.exists(path):
+            shutil.copyfile(path, tmp)
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+            db = dbm.gnu.open(tmp, 'w')
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+            db = dbm.gnu.open(tmp, 'n')
+        try:
+            for k in stale:
+                del db[k]
+            for (k, v) in changed.items():
+                db[k] = v
+            db[b'YP_LAST_MODIFIED'] = str(int(time.time())).encode()
+            db[b'YP_MASTER_NAME'] = master.encode()
+        finally:
+            db.close()
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    os.replace(tmp, path)
+    return True
+
+
+def write_nis_maps(maps_dir, files, master):
+    """
+    Update the NIS maps in maps_dir from the flat files (given as a dict of
+    'passwd'/'group' to the path of the file). Returns a list of the maps
+    which were changed.
+    """
+    updated = []
+    for (name, (source, field)) in NIS_MAPS.items():
+        entries = read_nis_map(files[source], field)
+        if update_nis_map(os.path.join(maps_dir, name), entries, master):
+            updated.append(name)
+    return updated
+
+
+# the version of the plans written by save_plan(), a plan from another
+# version isn't applied
+PLAN_VERSION = 1
+
+
+def save_plan(plan, path):
+    """Save a plan of changes (from syncbp or exportbp) as json"""
+    with AtomicFile(path) as f:
+        f.write(json.dumps(plan, indent=2) + "\n")
+
+
+def load_plan(path, script):
+    """
+    Load a plan saved by save_plan(), raising ValueError if it isn't one
+    made by script with this version of bluepages
+    """
+    with open(path, encoding='utf-8') as f:
+        plan = json.load(f)
+    if not isinstance(plan, dict) or plan.get('script') != script:
+        raise ValueError(f"not a plan made by {script}")
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError(f"plan version {plan.get('version')} is not {PLAN_VERSION}")
+    if 'database' not in plan:
+        raise ValueError("the plan has no database fingerprint")
+    return plan
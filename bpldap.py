@@ -0,0 +1,417 @@
+#
+# helpers shared by the bluepages scripts for talking to ldap / AD
+#
+
+import base64
+import collections
+import ldap
+import ldap.dn
+import ldap.filter
+import ldap.modlist
+from ldap.controls import SimplePagedResultsControl
+from ldap.controls.sss import SSSRequestControl
+
+
+class PagedSearch:
+    """
+    A search using the simple paged results control. The request for the
+    first page is sent as soon as the search is created, and each (dn, attrs)
+    result is yielded as it arrives when the search is iterated over.
+
+    Only one page of results is held in memory at a time, and result sets
+    bigger than the server side size limit (eg the AD MaxPageSize of 1000)
+    are returned in full rather than being cut off.
+    """
+
+    def __init__(self, directory, base, scope, criteria, attributes=None,
+            page_size=1000, controls=()):
+        self.directory = directory
+        self.args = (base, scope, criteria, attributes)
+        self.control = SimplePagedResultsControl(True, size=page_size, cookie='')
+        self.controls = list(controls)
+        self.msgid = self._request()
+
+    def _request(self):
+        return self.directory.search_ext(*self.args,
+                serverctrls=[self.control] + self.controls)
+
+    def __iter__(self):
+        while True:
+            (rtype, rdata, rmsgid, serverctrls) = self.directory.result3(self.msgid)
+
+            for entry in rdata:
+                yield entry
+
+            # the server hands back a cookie with each page, an empty cookie
+            # means that was the last page
+            cookie = None
+            for ctrl in serverctrls:
+                if ctrl.controlType == SimplePagedResultsControl.controlType:
+                    cookie = ctrl.cookie
+            if not cookie:
+                break
+            self.control.cookie = cookie
+            self.msgid = self._request()
+
+
+def paged_search(directory, base, scope, criteria, attributes=None,
+        page_size=1000, controls=()):
+    """
+    Search the directory using the simple paged results control and yield
+    each (dn, attrs) result as it arrives. Nothing is sent to the server
+    until the first result is asked for.
+    """
+    yield from PagedSearch(directory, base, scope, criteria, attributes,
+            page_size, controls)
+
+
+def search_values(directory, base, criteria, attribute, values,
+        attributes=None, batch=100, wildcard=None):
+    """
+    Return a dict of dn to attrs for the entries matching criteria whose
+    attribute has one of the given values. The values are looked up batch
+    at a time with an OR filter, rather than fetching everything under base.
+    If wildcard is given (eg '_*') entries whose attribute is one of the
+    values followed by the wildcard are returned too.
+    """
+    values = sorted(values)
+    patterns = ['%s']
+    if wildcard:
+        patterns.append('%s' + wildcard)
+    entries = {}
+    for i in range(0, len(values), batch):
+        match = "".join(f"({attribute}={pattern})" % ldap.filter.escape_filter_chars(v)
+                for v in values[i:i + batch] for pattern in patterns)
+        for (dn, attrs) in paged_search(directory, base, ldap.SCOPE_SUBTREE,
+                f"(&{criteria}(|{match}))", attributes):
+            if dn:
+                entries[dn] = attrs
+    return entries
+
+
+def sort_control(attribute):
+    """
+    Return a server side sort control which orders results by the given
+    attribute in the same (code point) order that sqlite uses for text.
+    The control is critical, so a server which can't sort fails the search
+    rather than quietly returning unsorted results.
+    """
+    return SSSRequestControl(True, [f"{attribute}:caseExactOrderingMatch"])
+
+
+class MergedSnapshot:
+    """
+    Match sorted search results against a sorted stream of our own entries,
+    so the existing entries don't all have to be held in memory.
+
+    This stands in for the dict of existing entries keyed by DN: pop(dn, key)
+    returns the attributes of the entry with that DN, or the default if there
+    isn't one, where key is the value of the sort attribute for that DN.
+    Calls to pop() must be made in sorted key order. Any entries passed over
+    without being matched are kept (just the DN) and, along with whatever is
+    left unread at the end, are given when iterating over the snapshot.
+    """
+
+    def __init__(self, results, attribute):
+        self.results = iter(results)
+        self.attribute = attribute
+        self.unmatched = []
+        self.head = None
+        self.head_key = None
+        self.started = False
+
+    def _key(self, attrs):
+        values = [str(v, encoding='utf-8') for v in attrs.get(self.attribute, [])]
+        return min(values) if values else ''
+
+    def _advance(self):
+        for (dn, attrs) in self.results:
+            # skip over any search references
+            if not dn:
+                continue
+            key = self._key(attrs)
+            if self.head_key is not None and key < self.head_key:
+                raise RuntimeError(f"ldap results are not sorted by {self.attribute}")
+            (self.head, self.head_key) = ((dn, attrs), key)
+            return
+        self.head = None
+
+    def pop(self, dn, key=None, default=None):
+        if not self.started:
+            self.started = True
+            self._advance()
+        if key is None:
+            key = str(ldap.dn.str2dn(dn)[0][0][1])
+
+        # anything sorting before the key we want has no entry of our own
+        while self.head and self.head_key < key:
+            self.unmatched.append(self.head[0])
+            self._advance()
+
+        match = default
+        while self.head and self.head_key == key:
+            if self.head[0] == dn:
+                match = self.head[1]
+            else:
+                self.unmatched.append(self.head[0])
+            self._advance()
+
+        return match
+
+    def __iter__(self):
+        if not self.started:
+            self.started = True
+            self._advance()
+        while self.head:
+            self.unmatched.append(self.head[0])
+            self._advance()
+        return iter(self.unmatched)
+
+
+class SearchQueue:
+    """
+    Run a number of paged searches concurrently over one connection.
+
+    Searches are added with a key and their results read back with
+    results(key). Up to `window` searches are kept in flight at once, so
+    while the results of one search are being processed the directory is
+    already working on the next ones. Reading the results back in the
+    order they were added gives the same output as running them serially.
+    """
+
+    def __init__(self, directory, window=4):
+        self.directory = directory
+        self.window = max(1, window)
+        self.pending = collections.OrderedDict()
+        self.started = {}
+
+    def add(self, key, base, scope, criteria, attributes=None, page_size=1000):
+        self.pending[key] = (base, scope, criteria, attributes, page_size)
+        self._fill()
+
+    def _fill(self):
+        while self.pending and len(self.started) < self.window:
+            (key, args) = self.pending.popitem(last=False)
+            self.started[key] = PagedSearch(self.directory, *args)
+
+    def results(self, key):
+        """Yield the results of the search added with the given key"""
+        if key in self.started:
+            search = self.started.pop(key)
+        else:
+            search = PagedSearch(self.directory, *self.pending.pop(key))
+
+        # top the window back up before we start reading this one
+        self._fill()
+        yield from search
+
+
+# attributes where the values are compared without regard to case. the
+# server will usually hand back objectClass values in its own capitalisation
+CASE_IGNORE_ATTRS = {'objectclass'}
+
+
+def modify_modlist(old, new):
+    """
+    Return the modlist to turn the old entry into the new one. This is an
+    empty list when nothing has changed, in which case there is no need to
+    send anything to the server.
+    """
+    return ldap.modlist.modifyModlist(old, new,
+            case_ignore_attr_types=CASE_IGNORE_ATTRS)
+
+
+class WritePipeline:
+    """
+    Send add/modify/delete operations to the directory without waiting for
+    each one to complete before sending the next.
+
+    Up to `window` operations are left outstanding, once the window is full
+    the oldest result is collected before another operation is sent. A
+    failed operation is recorded in `failures` as a (operation, dn, error)
+    tuple and printed, but doesn't stop the rest of the writes.
+    """
+
+    def __init__(self, directory, window=32):
+        self.directory = directory
+        self.window = max(1, window)
+        self.outstanding = collections.deque()
+        self.failures = []
+
+    def add(self, dn, modlist):
+        self._submit('add', dn, self.directory.add_ext, modlist)
+
+    def modify(self, dn, modlist):
+        self._submit('modify', dn, self.directory.modify_ext, modlist)
+
+    def delete(self, dn):
+        self._submit('delete', dn, self.directory.delete_ext)
+
+    def _submit(self, operation, dn, method, *args):
+        while len(self.outstanding) >= self.window:
+            self._collect()
+        try:
+            msgid = method(dn, *args)
+        except ldap.LDAPError as e:
+            self._failed(operation, dn, e)
+        else:
+            self.outstanding.append((operation, dn, msgid))
+
+    def _collect(self):
+        (operation, dn, msgid) = self.outstanding.popleft()
+        try:
+            self.directory.result3(msgid)
+        except ldap.LDAPError as e:
+            self._failed(operation, dn, e)
+
+    def _failed(self, operation, dn, error):
+        # python-ldap errors carry a dict with the details in the first arg
+        details = error.args[0] if error.args else {}
+        if isinstance(details, dict):
+            message = details.get('desc', str(error))
+            if details.get('info'):
+                message += f" ({details['info']})"
+        else:
+            message = str(error)
+        print(f"ERROR: could not {operation} ldap entry {dn}: {message}")
+        self.failures.append((operation, dn, message))
+
+    def flush(self):
+        """Wait for all the outstanding operations to complete"""
+        while self.outstanding:
+            self._collect()
+
+
+def ldif_line(attribute, value):
+    """
+    Return an LDIF attribute line, base64 encoding the value if it isn't a
+    safe string (RFC 2849) and folding the line at 76 characters
+    """
+    if isinstance(value, str):
+        value = value.encode()
+    if value and (value[:1] in (b' ', b':', b'<') or value.endswith(b' ')
+            or any(c > 127 or c in (0, 10, 13) for c in value)):
+        line = f"{attribute}:: {base64.b64encode(value).decode()}"
+    else:
+        line = f"{attribute}: {value.decode()}"
+    folded = [line[:76]] + [line[i:i + 75] for i in range(76, len(line), 75)]
+    return "\n ".join(folded)
+
+
+def ldif_record(dn, modlist, changetype=None):
+    """
+    Yield the lines of an LDIF record. modlist is an add modlist of
+    (attribute, values), or a modify modlist of (op, attribute, values) if
+    changetype is modify. With no changetype a content record is given,
+    as used by slapadd.
+    """
+    yield ldif_line('dn', dn)
+    if changetype:
+        yield f"changetype: {changetype}"
+
+    if changetype == 'modify':
+        ops = {ldap.MOD_ADD: 'add', ldap.MOD_DELETE: 'delete',
+                ldap.MOD_REPLACE: 'replace'}
+        for (op, attribute, values) in modlist:
+            yield f"{ops[op]}: {attribute}"
+            for value in values or []:
+                yield ldif_line(attribute, value)
+            yield "-"
+    elif changetype != 'delete':
+        for (attribute, values) in modlist:
+            for value in values:
+                yield ldif_line(attribute, value)
+    yield ""
+
+
+class LDIFWriter:
+    """
+    Stands in for a WritePipeline, writing the operations to a file as LDIF
+    rather than sending them to a directory. Each record is streamed out as
+    it is made, so nothing builds up in memory.
+
+    With changes=True the records are change records (add, modify and
+    delete) for ldapmodify. Otherwise adds are written as content records,
+    for loading into an empty directory with slapadd, and anything else is
+    an error.
+    """
+
+    def __init__(self, f, changes=True):
+        self.f = f
+        self.changes = changes
+        self.failures = []
+
+    def _write(self, lines):
+        for line in lines:
+            self.f.write(line + "\n")
+
+    def add(self, dn, modlist):
+        self._write(ldif_record(dn, modlist, self.changes and 'add' or None))
+
+    def modify(self, dn, modlist):
+        if not self.changes:
+            raise ValueError(f"can't modify {dn} in a content LDIF file")
+        self._write(ldif_record(dn, modlist, 'modify'))
+
+    def delete(self, dn):
+        if not self.changes:
+            raise ValueError(f"can't delete {dn} in a content LDIF file")
+        self._write(ldif_record(dn, [], 'delete'))
+
+    def flush(self):
+        self.f.flush()
+
+
+class ChangeRecorder:
+    """
+    Stands in for a WritePipeline when working out a plan, keeping the
+    operations in `changes` rather than sending them. Each is a dict which
+    can be saved as json, with the values decoded from utf-8 (undecodable
+    bytes survive as surrogates). replay() sends them later.
+    """
+
+    def __init__(self):
+        self.changes = []
+        self.failures = []
+
+    def add(self, dn, modlist):
+        self.changes.append({'operation': 'add', 'dn': dn,
+                'modlist': [[attribute, _decode(values)]
+                    for (attribute, values) in modlist]})
+
+    def modify(self, dn, modlist):
+        self.changes.append({'operation': 'modify', 'dn': dn,
+                'modlist': [[op, attribute, _decode(values)]
+                    for (op, attribute, values) in modlist]})
+
+    def delete(self, dn):
+        self.changes.append({'operation': 'delete', 'dn': dn})
+
+    def flush(self):
+        pass
+
+
+def _decode(values):
+    if values is None:
+        return None
+    return [value.decode('utf-8', 'surrogateescape') for value in values]
+
+
+def _encode(values):
+    if values is None:
+        return None
+    return [value.encode('utf-8', 'surrogateescape') for value in values]
+
+
+def replay(writes, changes):
+    """Send the operations kept by a ChangeRecorder to writes (eg a WritePipeline)"""
+    for change in changes:
+        if change['operation'] == 'add':
+            writes.add(change['dn'], [(attribute, _encode(values))
+                    for (attribute, values) in change['modlist']])
+        elif change['operation'] == 'modify':
+            writes.modify(change['dn'], [(op, attribute, _encode(values))
+                    for (op, attribute, values) in change['modlist']])
+        else:
+            writes.delete(change['dn'])
+    writes.flush()
@@ -0,0 +1,119 @@
+#
+# timings and counters from a bluepages run, written out as json and/or a
+# prometheus textfile collector file
+#
+
+import collections
+import contextlib
+import json
+import os
+import time
+import bpfiles
+
+
+class Metrics:
+    """
+    The timings and counters from one run of a bluepages script.
+
+    lap() adds the time since the last lap to the named phase of the run.
+    Other timings and counters are kept by name and an optional set of
+    labels, eg add_time('group_seconds', 0.5, group='research').
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.timestamp = time.time()
+        self.start = self.last = time.perf_counter()
+        self.phases = {}
+        self.timings = collections.defaultdict(float)
+        self.counters = collections.Counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def add_time(self, name, seconds, **labels):
+        self.timings[(name, tuple(sorted(labels.items())))] += seconds
+
+    def count(self, name, n=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += n
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, iterable, **labels):
+        """
+        Yield from iterable, adding the time spent waiting for each item
+        (eg for the next page of a search to arrive) to the named timing
+        """
+        waited = 0
+        items = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    waited += time.perf_counter() - start
+                yield item
+        finally:
+            self.add_time(name, waited, **labels)
+
+    def summary(self):
+        """Return the metrics as a dict, for json"""
+        def grouped(values):
+            out = collections.defaultdict(dict)
+            for ((name, labels), value) in sorted(values.items()):
+                out[name][",".join(f"{k}={v}" for (k, v) in labels)] = value
+            return dict(out)
+
+        return {'script': self.script, 'timestamp': self.timestamp,
+                'run_seconds': time.perf_counter() - self.start,
+                'phases': self.phases, 'timings': grouped(self.timings),
+                'counters': grouped(self.counters)}
+
+    def prometheus(self):
+        """Return the metrics in the prometheus text format"""
+        def line(name, labels, value):
+            # not job, which prometheus sets itself when it scrapes
+            labels = (('script', self.script),) + labels
+            text = ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                    .replace('"', '\\"').replace('\n', '\\n')) for (k, v) in labels)
+            return f"bluepages_{name}{{{text}}} {value}\n"
+
+        out = [line('last_run_timestamp_seconds', (), self.timestamp),
+                line('run_seconds', (), time.perf_counter() - self.start)]
+        out.extend(line('phase_seconds', (('phase', phase),), seconds)
+                for (phase, seconds) in self.phases.items())
+        for values in (self.timings, self.counters):
+            out.extend(line(name, labels, value)
+                    for ((name, labels), value) in sorted(values.items()))
+        return "".join(out)
+
+    def write(self, config):
+        """
+        Write the metrics out as set in the [metrics] section of the config:
+        json_dir gets {script}.json and textfile_dir gets bluepages_{script}.prom
+        for the node exporter textfile collector. Either can be left out.
+        """
+        if 'metrics' not in config:
+            return
+
+        if config['metrics'].get('json_dir'):
+            path = os.path.join(config['metrics']['json_dir'], f"{self.script}.json")
+            with bpfiles.AtomicFile(path) as f:
+                f.write(json.dumps(self.summary(), indent=2) + "\n")
+
+        if config['metrics'].get('textfile_dir'):
+            path = os.path.join(config['metrics']['textfile_dir'],
+                    f"bluepages_{self.script}.prom")
+            with bpfiles.AtomicFile(path) as f:
+                f.write(self.prometheus())
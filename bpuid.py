@@ -0,0 +1,138 @@
+#
+# UID allocation and SID decoding shared by the bluepages scripts
+#
+
+import bisect
+import struct
+
+_RID = struct.Struct('<L')
+
+
+def _check_sid(binary):
+    """Raise ValueError unless binary is a revision 1 SID of the right length"""
+    if len(binary) < 8 or binary[0] != 1 or len(binary) != 8 + 4 * binary[1]:
+        raise ValueError(f"not a valid SID: {bytes(binary).hex()}")
+
+
+def sid2string(binary):
+    """Return the S-1-5-21-... string form of a binary SID"""
+    _check_sid(binary)
+    authority = int.from_bytes(binary[2:8], 'big')
+    subauthorities = struct.unpack_from(f'<{binary[1]}L', binary, 8)
+    return f"S-1-{authority}" + "".join(f"-{s}" for s in subauthorities)
+
+
+def string2sid(text):
+    """Return the binary form of a S-1-5-21-... SID string"""
+    parts = text.split('-')
+    if len(parts) < 3 or parts[0].upper() != 'S' or parts[1] != '1':
+        raise ValueError(f"not a valid SID: {text}")
+    subauthorities = [int(p) for p in parts[3:]]
+    return bytes([1, len(subauthorities)]) + int(parts[2]).to_bytes(6, 'big') + \
+            struct.pack(f'<{len(subauthorities)}L', *subauthorities)
+
+
+def sid_rid(binary):
+    """
+    Return the RID of a binary SID, the last sub-authority
+    https://devblogs.microsoft.com/oldnewthing/20040315-00/?p=40253
+    """
+    _check_sid(binary)
+    return _RID.unpack_from(binary, len(binary) - 4)[0]
+
+
+class SIDMapper:
+    """
+    Map SIDs to UIDs the way sssd does, by adding the RID to the offset
+    for the domain. The offset and slice size are read from the
+    [directory] section once, rather than on every lookup.
+    """
+
+    def __init__(self, offset=200000, slice=20000):
+        self.offset = int(offset)
+        self.slice = int(slice)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('directory', 'sid_offset', fallback=200000),
+                config.get('directory', 'sid_slice', fallback=20000))
+
+    def uid(self, binary):
+        return self.offset + sid_rid(binary)
+
+    def uids(self, sids):
+        """
+        Return the UIDs for a list of binary SIDs (eg a page of search
+        results), unpacking all their RIDs with one struct call
+        """
+        for binary in sids:
+            _check_sid(binary)
+        rids = struct.unpack(f'<{len(sids)}L', b"".join(binary[-4:] for binary in sids))
+        return [self.offset + rid for rid in rids]
+
+
+class UIDAllocator:
+    """
+    Keep an index of the UIDs in use so that new ones can be picked without
+    scanning every user. Collision checks are a set lookup, and finding the
+    first free UID from some starting point is a binary search over a
+    sorted list of the used UIDs.
+    """
+
+    def __init__(self, uids=()):
+        # UIDs are integers in the database (bpdb.integer_ids made sure of
+        # that), but the column allows NULL for a user without one
+        self.used = {int(uid) for uid in uids if uid is not None}
+        self.sorted = sorted(self.used)
+
+    @classmethod
+    def from_db(cls, cur):
+        """Build an allocator from the UIDs in the passwd table"""
+        return cls(r[0] for r in cur.execute("select UID from passwd"))
+
+    def is_free(self, uid):
+        return int(uid) not in self.used
+
+    def add(self, uid):
+        """Mark a UID as used"""
+        uid = int(uid)
+        if uid not in self.used:
+            self.used.add(uid)
+            bisect.insort(self.sorted, uid)
+
+    def allocate(self, uid, step):
+        """
+        Return the first free UID out of uid, uid + step, uid + 2*step...
+        (ie the same RID in the following domain slices) and mark it as used
+        """
+        uid = int(uid)
+        while uid in self.used:
+            uid += step
+        self.add(uid)
+        return uid
+
+    def first_free(self, start):
+        """
+        Return the lowest unused UID which is >= start (without marking it
+        as used).
+
+        In the sorted list of used UIDs a run of consecutive UIDs is where
+        uid - index stays the same, so binary search for the end of the run
+        that start is in rather than stepping through it.
+        """
+        start = int(start)
+        used = self.sorted
+        i = bisect.bisect_left(used, start)
+        if i == len(used) or used[i] != start:
+            return start
+
+        # find the last index j where used[j] - j == used[i] - i
+        key = used[i] - i
+        (lo, hi) = (i, len(used) - 1)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if used[mid] - mid == key:
+                lo = mid
+            else:
+                hi = mid - 1
+        return used[lo] + 1
@@ -36,10 +36,15 @@ if [[ $rc -ne 0 ]]; then
     exit $rc
 fi
 
-# Do an update
-log=$($BP/exportbp.py 2>&1)
+# Do an update. exportbp exits with 3 if the passwd and group files
+# haven't changed, in which case there is no need to rebuild the maps
+log=$($BP/exportbp.py --unchanged-exit 2>&1)
 rc=$?
 
+if [[ $rc -eq 3 ]]; then
+    exit 0
+fi
+
 # If the update fails then log this and exit
 if [[ $rc -ne 0 ]]; then
     notify_error "update" "$log"
@@ -6,146 +6,120 @@
 
 import argparse
 import configparser
+import contextlib
+import json
 import sqlite3
 import sys
 import os
-import json
 import collections
+import itertools
+import re
+import socket
+import subprocess
+import time
 import ldap, ldap.modlist
+import bpdb
+import bpfiles
+import bpldap
+import bpmetrics
+
+
+# the fields indexed in the nss cache files, by their position in the entry
+PASSWD_INDEXES = {'name': 0, 'uid': 2}
+GROUP_INDEXES = {'name': 0, 'gid': 2}
 
 
 # https://serverfault.com/q/885324
-def get_smb_user_sid(uid):
+def get_smb_user_sid(uid, config):
     sid = config["samba"].get("sid")
     smbuid = int(uid) * 2 + 1000
     return f"{sid}-{smbuid}"
 
 
-config = configparser.ConfigParser()
-config.read(['/etc/bluepages.cfg', os.path.expanduser('~/.bluepages.cfg'), './bluepages.cfg'])
-
-description="A script to export the bp database to yp/ldap."
-parser = argparse.ArgumentParser(description=description)
-parser.add_argument('-d', '--db', metavar="DATABASE",
-        default=config.get('global', 'db', fallback='bp.db'))
-parser.add_argument('-p', '--passwd', metavar="FILE", 
-        default=config.get('global', 'passwd', fallback='passwd'))
-parser.add_argument('-g', '--group', metavar="FILE",
-        default=config.get('global', 'group', fallback='group'))
-parser.add_argument('-v', '--verbose', action="store_true")
-args = parser.parse_args()
-
-if not os.path.exists(args.db):
-    print("ERROR: File %s not found!" % (args.db))
-    sys.exit(1)
-
-try:
-    con = sqlite3.connect(args.db)
-except:
-    print("ERROR: Could not open database %s" % (args.db))
-    sys.exit(2)
-cur = con.cursor()
-
-
-directory = False
-previous_ldap_users = {}
-previous_ldap_groups = {}
-if 'ldap' in config:
-    # connect to the directory.
+def connect(config):
+    """
+    Connect and bind to the ldap server, or return False if there isn't
+    one configured
+    """
+    if 'ldap' not in config:
+        return False
+
     if config["ldap"].get("tls_reqcert"):
         ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
 
     directory = ldap.initialize(f"{config['ldap']['uri']}")
     directory.simple_bind_s(config['ldap']['binddn'],
                     config['ldap']['bindpw'])
-
-    # list any existing users. We will use this to match against 
-    # users as we process the bp user database so we know whether
-    # to create a new ldap user or update an existing one. As entries
-    # are matched we remove them from this dictionary - any users 
-    # left at the end are removed from ldap.
-    criteria = "(objectClass=posixAccount)"
-    results = directory.search_s(config['ldap']['users_ou'],
-            ldap.SCOPE_SUBTREE, criteria)
-
-    for (dn, attrs) in results:
-        previous_ldap_users[dn] = attrs
-
-
-    # list any existing groups - same process as with the users
-    criteria = '(objectClass=posixGroup)'
-    results = directory.search_s(config['ldap']['groups_ou'],
-            ldap.SCOPE_SUBTREE, criteria)
-
-    for (dn, attrs) in results:
-        previous_ldap_groups[dn] = attrs
-
-samba = False
-user_object_class = [b'top', b'person', b'organizationalPerson', b'inetorgperson', b'posixAccount']
-if 'samba' in config:
-    samba = True
-    user_object_class = [b'top', b'person', b'organizationalPerson', b'inetorgperson', b'posixAccount', b'sambaSamAccount']
-
-
-
-# get all users who are not inactive or disabled. 
-sql="""SELECT * FROM passwd 
-  WHERE status NOT IN ('inactive', 'disabled')
-  ORDER BY name ASC"""
-
-# keep a record of the users for matching against the group memberships
-# the key is the AD username, and the value is the linux username
-valid_user_map = {}
-
-with open(args.passwd, 'w') as f:
-    for r in cur.execute(sql):
-        user = dict(zip([c[0] for c in cur.description], r))
-
-        if args.verbose:
-            print(f"Adding user {user['name']}")
-
-        valid_user_map[user['sAMAccountName']] = user['name']
-
-        f.write("%s:%s:%s:%s:%s:%s:%s\n" % (user['name'],
-            user['password'], user['UID'], user['GID'], user['GECOS'], 
-            user['directory'], user['shell']))
-
-        if directory:
-            # create DN for new user
-            user_dn = f"uid={user['name']},{config['ldap']['users_ou']}"
-            gecos = user['GECOS']
-            if "" == gecos:
-               gecos = user['name']
-            attrs = {}
-            attrs['objectClass'] = user_object_class
-            attrs['cn'] = [user['name'].encode()]
-            attrs['uid'] = [user['name'].encode()]
-            attrs['sn'] = [user['sn'].encode()]
-            attrs['givenName'] = [user['givenName'].encode()]
-            attrs['uidNumber'] = [user['UID'].encode()]
-            attrs['gidNumber'] = [user['GID'].encode()]
-            attrs['loginShell'] = [user['shell'].encode()]
-            attrs['homeDirectory'] = [user['directory'].encode()]
-            attrs['gecos'] = [gecos.encode()]
-
-            if samba:
-                attrs['sambaSID'] = [get_smb_user_sid(user['UID']).encode()]
-
-            # create or update user ldap entry
-            if user_dn in previous_ldap_users:
-                mod = ldap.modlist.modifyModlist(previous_ldap_users[user_dn], attrs)
-                directory.modify_s(user_dn, mod)
-                del previous_ldap_users[user_dn]
-            else:
-                mod = ldap.modlist.addModlist(attrs)
-                directory.add_s(user_dn, mod)
-
-
-sql="""SELECT name, GID, user_list
-  FROM grp
-  ORDER BY name ASC"""
-
-with open(args.group, 'w') as f:
+    return directory
+
+
+def file_outputs(config, path, cache, indexes):
+    """
+    The files an export of path is written to: the file itself and, if
+    [nsscache] is configured, a libnss-cache file (with the given indexes)
+    of the same entries for clients to do local lookups from
+    """
+    outputs = [bpfiles.AtomicFile(path)]
+    if 'nsscache' in config:
+        cache_dir = config['nsscache'].get('dir', '/etc')
+        outputs.append(bpfiles.NssCacheFile(os.path.join(cache_dir, cache),
+                indexes))
+    return outputs
+
+
+def export(config, con, directory, passwd_path, group_path, verbose=False,
+        stream=False, changes=None, ldif=None, metrics=None, plan=None):
+    """
+    Export the active users and groups in the database to the passwd and
+    group files (and any NIS maps or nss cache files), and to the ldap
+    server if directory is set.
+
+    If changes is a bpdb.ChangeSet from a sync then only the ldap entries
+    of the users and groups in it are looked at, and nothing is done at
+    all if it is empty. The files are still written in full.
+
+    If ldif is a bpldap.LDIFWriter the ldap entries are written to it
+    rather than to the server. Without a directory to compare against they
+    are written in full, otherwise just the changes are. Nothing else is
+    touched: the files and NIS maps are left as they are.
+
+    If plan is a dict nothing is changed at all: the file contents (and
+    diffs) and ldap operations which would be written are added to it
+    instead, for apply_export() to make later.
+
+    Returns a tuple of whether the passwd or group files changed and a
+    Counter of the ldap entries added, modified, deleted, unchanged and
+    failed. The time taken by each phase and what was done is also added
+    to metrics if it is given.
+    """
+    if metrics is None:
+        metrics = bpmetrics.Metrics('exportbp')
+    cur = con.cursor()
+
+    # make sure the tables are there, and upgrade them if they are from an
+    # older version
+    bpdb.upgrade(cur)
+    metrics.lap("prepare database")
+
+    # when exporting the changes from a sync work out which users and groups
+    # are affected. a group is if any of its members changed status.
+    partial = changes is not None and not changes.rebuild
+    if partial:
+        if not changes and os.path.exists(passwd_path) and os.path.exists(group_path):
+            if verbose:
+                print("Nothing has changed since the last export")
+            return (False, collections.Counter())
+
+        cur.execute("""CREATE TEMP TABLE changed_user
+            (sAMAccountName text NOT NULL PRIMARY KEY)""")
+        cur.executemany("INSERT INTO changed_user VALUES (?)",
+                [(account,) for account in changes.users])
+        changed_names = [r[0] for r in cur.execute("""SELECT name FROM passwd
+            WHERE sAMAccountName IN (select sAMAccountName from changed_user)""")]
+        changed_groups = changes.groups | {r[0] for r in cur.execute(
+            """SELECT DISTINCT grp FROM group_member
+            WHERE sAMAccountName IN (select sAMAccountName from changed_user)""")}
+        cur.execute("DROP TABLE changed_user")
 
     # We want to avoid the length of any line of the group file being
     # more than 1024 characters. The default max entry length of 924
@@ -153,89 +127,573 @@ with open(args.group, 'w') as f:
     max_entry_length = int(config.get('DEFAULT', 'max_entry_length',
             fallback='924'))
 
-    for r in cur.execute(sql):
-        group = dict(zip([c[0] for c in cur.description], r))
-    
-        # the user list is stored in the database in json
-        ad_user_list = json.loads(group['user_list'])
-
-        # Build a list of LINUX usernames for the group membership.
-        # Users which aren't published to the passwd file will be excluded
-        # at this point
-        user_list = []
-        for aduser in ad_user_list:
-            if aduser in valid_user_map:
-                user_list.append(valid_user_map[aduser])
-
-        # sort the list so that we print the entries sorted in the group file
-        user_list.sort()
-
-        if user_list:
-            if args.verbose:
-                print(f"Adding group {group['name']}")
-
-            # split the user list into slices, a new slice is begun if adding 
-            # another item would push it beyond the maximum entry length
-            s = 0
-            user_list_slices = collections.defaultdict(list)
-            for user in user_list:
-                if len(",".join(user_list_slices[s]))+len(user)+1 > max_entry_length:
-                    s += 1
-                user_list_slices[s].append(user)
-
-            # loop over the slices sorted in descending order, so that the 
-            # 'real' group name is printed last.
-            for (i, users) in sorted(user_list_slices.items(), reverse=True):
-                if i == 0:
-                    name = group['name']
+    # groups which are too long are split into name_N groups in the group
+    # file (and so the NIS maps and nss cache) with 'files', in ldap as well
+    # with 'all', or not at all with 'none'
+    split_groups = config.get('DEFAULT', 'split_groups', fallback='files')
+    if split_groups not in ('files', 'all', 'none'):
+        print(f"ERROR: Unknown split_groups setting {split_groups}")
+        sys.exit(2)
+
+    samba = False
+    user_object_class = [b'top', b'person', b'organizationalPerson', b'inetorgperson', b'posixAccount']
+    if 'samba' in config:
+        samba = True
+        user_object_class = [b'top', b'person', b'organizationalPerson', b'inetorgperson', b'posixAccount', b'sambaSamAccount']
+
+    previous_ldap_users = {}
+    previous_ldap_groups = {}
+
+    # count what we do to ldap entries so we can report on it at the end
+    ldap_changes = collections.Counter()
+    writes = None
+    if plan is not None:
+        # the operations are kept for the plan rather than made
+        writes = bpldap.ChangeRecorder() if directory else None
+    elif ldif:
+        # the entries are written out as LDIF instead of being sent to the
+        # server. without a directory to compare against they are all new.
+        writes = ldif
+    elif directory:
+        # writes are sent without waiting for each one to finish, with up to
+        # write_window of them outstanding at once
+        writes = bpldap.WritePipeline(directory,
+                int(config['ldap'].get('write_window', 32)))
+
+    if directory:
+        # only ask for the attributes we manage, anything else on the entries
+        # is no concern of ours and just takes up memory
+        user_attributes = ['objectClass', 'cn', 'uid', 'sn', 'givenName',
+                'uidNumber', 'gidNumber', 'loginShell', 'homeDirectory', 'gecos']
+        if samba:
+            user_attributes.append('sambaSID')
+        group_attributes = ['objectClass', 'cn', 'gidNumber', 'uniqueMember']
+        page_size = int(config['ldap'].get('page_size', 1000))
+
+        # list any existing users. We will use this to match against 
+        # users as we process the bp user database so we know whether
+        # to create a new ldap user or update an existing one. As entries
+        # are matched we remove them from this dictionary - any users 
+        # left at the end are removed from ldap.
+        criteria = "(objectClass=posixAccount)"
+        if partial:
+            # only look up the entries for the users that changed
+            previous_ldap_users = bpldap.search_values(directory,
+                    config['ldap']['users_ou'], criteria, 'uid', changed_names,
+                    user_attributes)
+        elif stream:
+            # rather than holding every entry in memory, have the server sort
+            # them in the same order as the database query and merge the two
+            # as we go
+            results = bpldap.paged_search(directory, config['ldap']['users_ou'],
+                    ldap.SCOPE_SUBTREE, criteria, user_attributes, page_size,
+                    [bpldap.sort_control('uid')])
+            previous_ldap_users = bpldap.MergedSnapshot(results, 'uid')
+        else:
+            results = bpldap.paged_search(directory, config['ldap']['users_ou'],
+                    ldap.SCOPE_SUBTREE, criteria, user_attributes, page_size)
+
+            for (dn, attrs) in results:
+                previous_ldap_users[dn] = attrs
+
+
+        # list any existing groups - same process as with the users
+        criteria = '(objectClass=posixGroup)'
+        if partial:
+            if split_groups == 'all':
+                # the name_N entries are wanted too, but the wildcard can
+                # also match other groups which start with the same name
+                # so leave those out
+                results = bpldap.search_values(directory,
+                        config['ldap']['groups_ou'], criteria, 'cn',
+                        changed_groups, group_attributes, wildcard='_*')
+                pattern = re.compile("(%s)(_[0-9]+)?" % "|".join(
+                        re.escape(name) for name in changed_groups))
+                previous_ldap_groups = {dn: attrs
+                        for (dn, attrs) in results.items()
+                        if pattern.fullmatch(str(attrs['cn'][0], encoding='utf-8'))}
+            else:
+                previous_ldap_groups = bpldap.search_values(directory,
+                        config['ldap']['groups_ou'], criteria, 'cn',
+                        changed_groups, group_attributes)
+        elif stream and split_groups != 'all':
+            # split groups can't be merged in sorted order (name_N comes
+            # before name), but there are few enough groups to hold them
+            # all in memory in that case
+            results = bpldap.paged_search(directory, config['ldap']['groups_ou'],
+                    ldap.SCOPE_SUBTREE, criteria, group_attributes, page_size,
+                    [bpldap.sort_control('cn')])
+            previous_ldap_groups = bpldap.MergedSnapshot(results, 'cn')
+        else:
+            results = bpldap.paged_search(directory, config['ldap']['groups_ou'],
+                    ldap.SCOPE_SUBTREE, criteria, group_attributes, page_size)
+
+            for (dn, attrs) in results:
+                previous_ldap_groups[dn] = attrs
+
+    # when streaming this is only the time to send the searches, the results
+    # are read as the users and groups are exported
+    metrics.lap("load ldap entries")
+
+    # get all users who are not inactive or disabled. 
+    sql="""SELECT * FROM passwd 
+      WHERE status NOT IN ('inactive', 'disabled')
+      ORDER BY name ASC"""
+
+    # the passwd file is written to a temporary file and only moved into
+    # place if it has changed. a plan just keeps what would be written, the
+    # nss cache files are made from that when it is applied. LDIF output
+    # is offline, so the files aren't written at all.
+    if plan is not None:
+        passwd_outputs = [bpfiles.PlanFile(passwd_path)]
+    elif ldif:
+        passwd_outputs = [bpfiles.NullFile()]
+    else:
+        passwd_outputs = file_outputs(config, passwd_path, 'passwd.cache',
+                PASSWD_INDEXES)
+    passwd_file = passwd_outputs[0]
+
+    with bpfiles.TeeFile(*passwd_outputs) as f:
+        for r in cur.execute(sql):
+            user = dict(zip([c[0] for c in cur.description], r))
+
+            if verbose:
+                print(f"Adding user {user['name']}")
+
+            f.write("%s:%s:%s:%s:%s:%s:%s\n" % (user['name'],
+                user['password'], user['UID'], user['GID'], user['GECOS'], 
+                user['directory'], user['shell']))
+
+            if writes and (not partial
+                    or user['sAMAccountName'] in changes.users):
+                # create DN for new user
+                user_dn = f"uid={user['name']},{config['ldap']['users_ou']}"
+                gecos = user['GECOS']
+                if "" == gecos:
+                   gecos = user['name']
+                attrs = {}
+                attrs['objectClass'] = user_object_class
+                attrs['cn'] = [user['name'].encode()]
+                attrs['uid'] = [user['name'].encode()]
+                attrs['sn'] = [user['sn'].encode()]
+                attrs['givenName'] = [user['givenName'].encode()]
+                attrs['uidNumber'] = [str(user['UID']).encode()]
+                attrs['gidNumber'] = [str(user['GID']).encode()]
+                attrs['loginShell'] = [user['shell'].encode()]
+                attrs['homeDirectory'] = [user['directory'].encode()]
+                attrs['gecos'] = [gecos.encode()]
+
+                if samba:
+                    attrs['sambaSID'] = [get_smb_user_sid(user['UID'], config).encode()]
+
+                # create or update user ldap entry. only send a modify if
+                # something has actually changed
+                previous = previous_ldap_users.pop(user_dn, None)
+                if previous is not None:
+                    mod = bpldap.modify_modlist(previous, attrs)
+                    if mod:
+                        writes.modify(user_dn, mod)
+                        ldap_changes['modified'] += 1
+                    else:
+                        ldap_changes['unchanged'] += 1
                 else:
-                    name = f"{group['name']}_{i}"
-
-                if args.verbose and i == 1:
-                    print(f"Entries for group {group['name']} have exceeded the maximum length and will be split.")
+                    mod = ldap.modlist.addModlist(attrs)
+                    writes.add(user_dn, mod)
+                    ldap_changes['added'] += 1
+
+            metrics.count('passwd_entries')
+
+    metrics.lap("export users")
+
+    # get all the groups along with the LINUX usernames of their members.
+    # members which aren't published to the passwd file are excluded by the
+    # join, leaving a NULL member for the group if there are none left.
+    sql="""SELECT grp.name, grp.GID, passwd.name
+      FROM grp
+      LEFT JOIN group_member ON group_member.grp = grp.name
+      LEFT JOIN passwd ON passwd.sAMAccountName = group_member.sAMAccountName
+        AND passwd.status NOT IN ('inactive', 'disabled')
+      ORDER BY grp.name ASC, passwd.name ASC"""
+
+    if plan is not None:
+        group_outputs = [bpfiles.PlanFile(group_path)]
+    elif ldif:
+        group_outputs = [bpfiles.NullFile()]
+    else:
+        group_outputs = file_outputs(config, group_path, 'group.cache',
+                GROUP_INDEXES)
+    group_file = group_outputs[0]
+
+    with bpfiles.TeeFile(*group_outputs) as f:
+        for ((name, GID), rows) in itertools.groupby(cur.execute(sql),
+                key=lambda r: r[:2]):
+            group = {'name': name, 'GID': GID}
+
+            # the list of LINUX usernames for the group membership comes back
+            # from the database already sorted, so the entries are printed
+            # sorted in the group file
+            user_list = [r[2] for r in rows if r[2] is not None]
+
+            if verbose:
+                if user_list:
+                    print(f"Adding group {group['name']}")
+                else:
+                    print(f"Adding empty group {group['name']}")
 
+            # split the user list into slices which fit in the maximum entry
+            # length. they are in descending order, so that the 'real' group
+            # name is printed last.
+            if split_groups == 'none':
+                lines = [(group['name'], user_list)]
+            else:
+                lines = bpfiles.split_group(group['name'], user_list,
+                        max_entry_length)
+            if verbose and len(lines) > 1:
+                print(f"Entries for group {group['name']} have exceeded the maximum length and will be split.")
+
+            metrics.count('groups')
+            metrics.count('group_lines', len(lines))
+            for (name, users) in lines:
                 f.write("%s:%s:%s:%s\n" % (name, 'x', group['GID'], ",".join(users)))
 
-        else:
-            if args.verbose:
-                print(f"Adding empty group {group['name']}")
-
-            f.write("%s:%s:%s:\n" % (group['name'],
-                'x', group['GID']))
-
-
-        if directory:
-            group_dn = f"cn={group['name']},{config['ldap']['groups_ou']}"
-            attrs = {}
-            attrs['objectClass'] = [b'top', b'groupOfUniqueNames', b'posixGroup']
-            attrs['cn'] = [group['name'].encode()]
-            attrs['gidNumber'] = [group['GID'].encode()]
-            if user_list:
-                attrs['uniqueMember'] = []
-                for user in user_list:
-                    user_dn = f"uid={user},{config['ldap']['users_ou']}"
-                    attrs['uniqueMember'].append(user_dn.encode())
-
-            # create or modify the group
-            if group_dn in previous_ldap_groups:
-                mod = ldap.modlist.modifyModlist(previous_ldap_groups[group_dn], attrs)
-                directory.modify_s(group_dn, mod)
-                del previous_ldap_groups[group_dn]
+
+            if writes and (not partial or group['name'] in changed_groups):
+                entries = [(group['name'], user_list)]
+                if split_groups == 'all':
+                    entries = lines
+
+                for (name, users) in entries:
+                    group_dn = f"cn={name},{config['ldap']['groups_ou']}"
+                    attrs = {}
+                    attrs['objectClass'] = [b'top', b'groupOfUniqueNames', b'posixGroup']
+                    attrs['cn'] = [name.encode()]
+                    attrs['gidNumber'] = [str(group['GID']).encode()]
+                    if users:
+                        attrs['uniqueMember'] = []
+                        for user in users:
+                            user_dn = f"uid={user},{config['ldap']['users_ou']}"
+                            attrs['uniqueMember'].append(user_dn.encode())
+
+                    # create or modify the group
+                    previous = previous_ldap_groups.pop(group_dn, None)
+                    if previous is not None:
+                        mod = bpldap.modify_modlist(previous, attrs)
+                        if mod:
+                            writes.modify(group_dn, mod)
+                            ldap_changes['modified'] += 1
+                        else:
+                            ldap_changes['unchanged'] += 1
+                    else:
+                        mod = ldap.modlist.addModlist(attrs)
+                        writes.add(group_dn, mod)
+                        ldap_changes['added'] += 1
+
+    metrics.lap("export groups")
+
+    # any user or group DNs that are still in the set captured at the start
+    # must be ones we didn't match against current bp so drop these. when
+    # only exporting changes these are the users and groups which were
+    # deactivated or removed.
+    if writes:
+        for dn in itertools.chain(previous_ldap_users, previous_ldap_groups):
+            if ldif:
+                print(f"Writing delete for {dn} as there was no corresponding bp entry matched")
+            elif plan is not None:
+                print(f"Would remove ldap entry {dn} as there was no corresponding bp entry matched")
             else:
-                mod = ldap.modlist.addModlist(attrs)
-                directory.add_s(group_dn, mod)
+                print(f"Removing ldap entry {dn} as there was no corresponding bp entry matched")
+            writes.delete(dn)
+            ldap_changes['deleted'] += 1
+
+        # wait for everything we've sent to finish
+        writes.flush()
+        ldap_changes['failed'] = len(writes.failures)
+
+        # a plan's changes are summed up by print_plan()
+        report_ldap_changes(ldap_changes, "LDIF" if ldif else "LDAP",
+                verbose, metrics, quiet=plan is not None)
+
+    # the passwd and group files are only replaced if their content changed
+    files_changed = passwd_file.changed or group_file.changed
+    if verbose and not files_changed and not ldif:
+        print("The passwd and group files are unchanged")
+    metrics.count('files_changed', int(files_changed))
+
+    if plan is not None:
+        plan.update({'version': bpfiles.PLAN_VERSION, 'script': 'exportbp',
+                'created': int(time.time()),
+                'files': [passwd_file.summary(), group_file.summary()],
+                'ldap': writes and writes.changes or [],
+                'ldap_changes': dict(ldap_changes)})
+        return (files_changed, ldap_changes)
+
+    # LDIF output doesn't count as an export as it may never be loaded
+    if ldif:
+        return (files_changed, ldap_changes)
+
+    update_nis_maps(config, passwd_path, group_path, verbose, metrics)
+
+    # everything has been exported now, unless some ldap writes failed in
+    # which case the next export needs to be a full one to have another go
+    bpdb.set_export_pending(cur, bool(ldap_changes['failed']))
+    con.commit()
+
+    return (files_changed, ldap_changes)
+
+
+def report_ldap_changes(ldap_changes, label, verbose, metrics, quiet=False):
+    """Print (unless quiet) and count what was done to the ldap entries"""
+    if not quiet and (verbose or ldap_changes['added'] or ldap_changes['modified']
+            or ldap_changes['deleted'] or ldap_changes['failed']):
+        print(label + " entries: {added} added, {modified} modified, "
+                "{deleted} deleted, {unchanged} unchanged, "
+                "{failed} failed".format_map(ldap_changes))
+
+    for change in ('added', 'modified', 'deleted', 'unchanged', 'failed'):
+        metrics.count('ldap_entries', ldap_changes[change], change=change)
+    metrics.lap("ldap writes")
+
+
+def update_nis_maps(config, passwd_path, group_path, verbose, metrics):
+    """
+    Build the NIS maps straight from the passwd and group files, if [nis]
+    is configured. only the keys which have changed are updated, and only
+    changed maps are pushed to the slave servers.
+    """
+    if 'nis' not in config:
+        return
+
+    maps_dir = config['nis']['maps_dir']
+    updated = bpfiles.write_nis_maps(maps_dir,
+            {'passwd': passwd_path, 'group': group_path},
+            config['nis'].get('master', socket.getfqdn()))
+
+    for name in updated:
+        if verbose:
+            print(f"Updated NIS map {name}")
+        if config['nis'].get('yppush'):
+            domain = config['nis'].get('domain', os.path.basename(maps_dir))
+            result = subprocess.run([config['nis']['yppush'], '-d', domain, name],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            if result.returncode:
+                print(f"ERROR: yppush of {name} failed: {result.stdout}")
+
+    metrics.count('nis_maps_updated', len(updated))
+    metrics.lap("nis maps")
+
+
+def apply_export(config, con, directory, plan, verbose=False, metrics=None):
+    """
+    Make the changes in a plan from export(): write the files it has the
+    content of (and the nss cache files and NIS maps made from them) and
+    send its ldap operations to directory. The caller should check the
+    database and files haven't changed since the plan was made, changes
+    made to the ldap server in between aren't noticed, the operations
+    which no longer make sense just fail.
+
+    Returns the same as export().
+    """
+    if metrics is None:
+        metrics = bpmetrics.Metrics('exportbp')
+    cur = con.cursor()
+
+    (passwd, group) = plan['files']
+    outputs = [file_outputs(config, passwd['path'], 'passwd.cache', PASSWD_INDEXES),
+            file_outputs(config, group['path'], 'group.cache', GROUP_INDEXES)]
+    for (entry, files) in zip(plan['files'], outputs):
+        with bpfiles.TeeFile(*files) as f:
+            f.write(entry['content'])
+    files_changed = outputs[0][0].changed or outputs[1][0].changed
+    if verbose and not files_changed:
+        print("The passwd and group files are unchanged")
+    metrics.count('files_changed', int(files_changed))
+    metrics.lap("write files")
+
+    ldap_changes = collections.Counter(plan['ldap_changes'])
+    if plan['ldap']:
+        writes = bpldap.WritePipeline(directory,
+                int(config['ldap'].get('write_window', 32)))
+        bpldap.replay(writes, plan['ldap'])
+        ldap_changes['failed'] = len(writes.failures)
+        report_ldap_changes(ldap_changes, "LDAP", verbose, metrics)
+
+    update_nis_maps(config, passwd['path'], group['path'], verbose, metrics)
+
+    bpdb.set_export_pending(cur, bool(ldap_changes['failed']))
+    con.commit()
+
+    return (files_changed, ldap_changes)
+
+
+def print_plan(plan):
+    """Print what a plan from export() would change"""
+    for entry in plan['files']:
+        if entry['changed']:
+            print(entry['diff'], end="")
+        else:
+            print(f"{entry['path']} is unchanged")
+    for change in plan['ldap']:
+        if change['operation'] == 'modify':
+            print(f"modify {change['dn']}: " + ", ".join(sorted(
+                    {attribute for (op, attribute, values) in change['modlist']})))
+        else:
+            print(f"{change['operation']} {change['dn']}")
+    print("Planned LDAP changes: {added} to add, {modified} to modify, "
+            "{deleted} to delete, {unchanged} unchanged".format_map(
+                collections.Counter(plan['ldap_changes'])))
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read(['/etc/bluepages.cfg', os.path.expanduser('~/.bluepages.cfg'), './bluepages.cfg'])
+
+    description="A script to export the bp database to yp/ldap."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d', '--db', metavar="DATABASE",
+            default=config.get('global', 'db', fallback='bp.db'))
+    parser.add_argument('-p', '--passwd', metavar="FILE", 
+            default=config.get('global', 'passwd', fallback='passwd'))
+    parser.add_argument('-g', '--group', metavar="FILE",
+            default=config.get('global', 'group', fallback='group'))
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('-u', '--unchanged-exit', action="store_true",
+            help='exit with status 3 if the passwd and group files are unchanged')
+    parser.add_argument('--stream', action="store_true",
+            default=config.getboolean('ldap', 'stream', fallback=False),
+            help='merge sorted ldap results with the database rather than '
+            'loading all existing ldap entries into memory')
+    parser.add_argument('--ldif', metavar="FILE", type=argparse.FileType('w', encoding='utf-8'),
+            help='write all the ldap entries to FILE as LDIF (eg for slapadd) '
+            'instead of updating the ldap server. the passwd and group files '
+            'and NIS maps are left alone')
+    parser.add_argument('--ldif-delta', metavar="FILE", type=argparse.FileType('w', encoding='utf-8'),
+            help='write the changes needed to bring the ldap server up to '
+            'date to FILE as LDIF (eg for ldapmodify -c) instead of making them. '
+            'the passwd and group files and NIS maps are left alone')
+    parser.add_argument('--plan', nargs='?', const='', metavar="FILE",
+            help='work out what an export would change (file diffs and ldap '
+            'operations) and print it, without changing anything. the plan '
+            'is saved to FILE if given, for --apply')
+    parser.add_argument('--json', action="store_true",
+            help='print the plan as json rather than a summary (with --plan)')
+    parser.add_argument('--apply', metavar="PLAN",
+            help='make the changes in a plan saved by --plan, without looking '
+            'at the ldap server again')
+    args = parser.parse_args()
+
+    if (args.plan is not None or args.apply) and (args.ldif or args.ldif_delta):
+        parser.error("--plan and --apply can't be used with --ldif or --ldif-delta")
+    if args.plan is not None and args.apply:
+        parser.error("--plan and --apply can't be used together")
+    if args.json and args.plan is None:
+        parser.error("--json can only be used with --plan")
+
+    if (args.ldif or args.ldif_delta) and 'ldap' not in config:
+        print("ERROR: The [ldap] section must be configured to write LDIF")
+        sys.exit(2)
+
+    if not os.path.exists(args.db):
+        print("ERROR: File %s not found!" % (args.db))
+        sys.exit(1)
+
+    try:
+        con = sqlite3.connect(args.db)
+    except:
+        print("ERROR: Could not open database %s" % (args.db))
+        sys.exit(2)
+
+    # bring the database schema up to date before anything else uses it
+    try:
+        bpdb.upgrade(con.cursor())
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(2)
+
+    # NIS maps can be written directly, rather than by make and makedbm, if
+    # python has the gdbm module
+    if 'nis' in config:
+        try:
+            import dbm.gnu
+        except ImportError:
+            print("ERROR: The python gdbm module (dbm.gnu) is needed to write NIS maps")
+            sys.exit(2)
+
+    metrics = bpmetrics.Metrics('exportbp')
+
+    if args.apply:
+        # the plan has the files and ldap operations worked out from the
+        # database and files as they were, so they mustn't have changed
+        try:
+            plan = bpfiles.load_plan(args.apply, 'exportbp')
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Could not read plan {args.apply}: {e}")
+            sys.exit(2)
+        if bpdb.fingerprint(con.cursor()) != plan['database']:
+            print(f"ERROR: The database has changed since {args.apply} was made")
+            sys.exit(2)
+        for entry in plan['files']:
+            if bpfiles.file_hash(entry['path']) != entry['old_hash']:
+                print(f"ERROR: {entry['path']} has changed since {args.apply} was made")
+                sys.exit(2)
+
+        directory = None
+        if plan['ldap']:
+            directory = connect(config)
+            if not directory:
+                print("ERROR: The [ldap] section must be configured to apply the ldap changes")
+                sys.exit(2)
+            metrics.lap("connect")
+        (files_changed, ldap_changes) = apply_export(config, con, directory,
+                plan, args.verbose, metrics)
+    elif args.plan is not None:
+        directory = connect(config)
+        metrics.lap("connect")
+        plan = {}
+        # keep stdout for the plan itself if it is being printed as json
+        with contextlib.redirect_stdout(args.json and sys.stderr or sys.stdout):
+            export(config, con, directory, args.passwd, args.group,
+                    args.verbose, args.stream, metrics=metrics, plan=plan)
+        plan['database'] = bpdb.fingerprint(con.cursor())
+        con.close()
+        if args.json:
+            print(json.dumps(plan, indent=2))
+        else:
+            print_plan(plan)
+        if args.plan:
+            bpfiles.save_plan(plan, args.plan)
+        sys.exit(0)
+    else:
+        ldif = None
+        if args.ldif:
+            directory = None
+            ldif = bpldap.LDIFWriter(args.ldif, changes=False)
+        else:
+            directory = connect(config)
+            metrics.lap("connect")
+            if args.ldif_delta:
+                ldif = bpldap.LDIFWriter(args.ldif_delta)
+
+        (files_changed, ldap_changes) = export(config, con, directory,
+                args.passwd, args.group, args.verbose, args.stream, ldif=ldif,
+                metrics=metrics)
+
+    # close sqlite database connection
+    con.close()
+
+    metrics.write(config)
+    if args.verbose:
+        for (phase, seconds) in metrics.phases.items():
+            print(f"{phase:>30}: {seconds:.3f}s")
 
+    # if any of the ldap writes failed make sure the caller knows about it
+    if ldap_changes['failed']:
+        sys.exit(1)
 
-# any user or group DNs that are still in the set captured at the start
-# must be ones we didn't match against current bp so drop these
-if directory:
-    for dn in previous_ldap_users:
-        print(f"Removing ldap entry {dn} as there was no corresponding bp entry matched")
-        directory.delete_s(dn)
+    # let the caller know that there is no need to rebuild anything from the
+    # passwd and group files
+    if args.unchanged_exit and not files_changed:
+        sys.exit(3)
 
-    for dn in previous_ldap_groups:
-        print(f"Removing ldap entry {dn} as there was no corresponding bp entry matched")
-        directory.delete_s(dn)    
 
-# close sqlite database connection
-con.close()
+if __name__ == '__main__':
+    main()
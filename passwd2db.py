@@ -9,6 +9,160 @@ import configparser
 import sqlite3
 import sys
 import os
+import time
+import itertools
+import bpdb
+
+
+def chunks(rows, size):
+    """Split an iterable of rows up into lists of at most size rows"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Importer:
+    """
+    Turn passwd and group format files into rows for the database, checking
+    them against the users already there (when merging). Lines which can't
+    be used are written to rejects (a file) along with the file they came
+    from, their line number and the reason, or warned about if there isn't
+    one.
+    """
+
+    def __init__(self, cur, status, rejects=None):
+        self.status = status
+        self.rejects = rejects
+        self.rejected = 0
+
+        # the account names already in the database (only when merging). the
+        # key is the account name and the value the linux username.
+        self.accounts = dict(cur.execute("select sAMAccountName, name from passwd"))
+
+        # likewise the UIDs in use and who has them, and each existing user's
+        # UID so it can be freed up if the import gives them a new one
+        self.uids = dict(cur.execute("select UID, name from passwd"))
+        self.old_uids = dict(cur.execute("select name, UID from passwd"))
+
+    def reject(self, path, lineno, line, reason):
+        """Record a line of input we couldn't use and why"""
+        self.rejected += 1
+        if self.rejects:
+            self.rejects.write(f"{path}\t{lineno}\t{reason}\t{line}\n")
+        else:
+            print("WARNING: could not import entry %s from %s (%s)" % (line, path, reason))
+
+    def parse_passwd(self, f):
+        """
+        Yield a passwd table row (as a dict) for each usable line of a passwd
+        format file. Anything else is rejected.
+        """
+        seen = set()
+        waiting = []
+        for (lineno, line) in enumerate(f, 1):
+            line = line.rstrip()
+            if not line.strip():
+                continue
+
+            fields = line.split(':')
+            if len(fields) != 7:
+                self.reject(f.name, lineno, line, "expected 7 fields")
+                continue
+            (name, password, UID, GID, GECOS, directory, shell) = fields
+
+            if not name:
+                self.reject(f.name, lineno, line, "no user name")
+                continue
+            if not UID.isdigit() or not GID.isdigit():
+                self.reject(f.name, lineno, line, "UID and GID must be numbers")
+                continue
+            if name in seen:
+                self.reject(f.name, lineno, line, "duplicate user name")
+                continue
+            # the account name has to be unique too, and when merging it could
+            # already belong to someone else
+            if self.accounts.get(name, name) != name:
+                self.reject(f.name, lineno, line,
+                        f"account name already used by {self.accounts[name]}")
+                continue
+            seen.add(name)
+
+            # set the givenName and sn fields to the same as the username
+            # unless it splits (eg firstname.lastname format)
+            givenName = name
+            sn = name
+            if '.' in name:
+                (givenName, sn) = name.title().split('.', 1)
+
+            row = {'name': name, 'sAMAccountName': name, 'password': password,
+                    'UID': int(UID), 'GID': int(GID), 'GECOS': GECOS,
+                    'directory': directory, 'shell': shell, 'status': self.status,
+                    'givenName': givenName, 'sn': sn, 'source': None}
+
+            # the UID has to be unique too. if someone already has it they
+            # may be given a new one further down the file, so wait and see.
+            if self.uids.get(row['UID'], name) != name:
+                waiting.append((lineno, line, row))
+                continue
+            yield self.claim_uid(row)
+
+        # anything still waiting gets its UID if the owner has moved off it
+        # (which may free up another one), otherwise it is rejected
+        while waiting:
+            still_waiting = []
+            for (lineno, line, row) in waiting:
+                if row['UID'] in self.uids:
+                    still_waiting.append((lineno, line, row))
+                else:
+                    yield self.claim_uid(row)
+            if len(still_waiting) == len(waiting):
+                break
+            waiting = still_waiting
+        for (lineno, line, row) in waiting:
+            self.reject(f.name, lineno, line,
+                    f"UID already used by {self.uids[row['UID']]}")
+
+    def claim_uid(self, row):
+        """Mark the row's UID as taken, freeing the user's old one"""
+        old_uid = self.old_uids.get(row['name'])
+        if self.uids.get(old_uid) == row['name']:
+            del self.uids[old_uid]
+        self.uids[row['UID']] = row['name']
+        return row
+
+    def parse_group(self, f):
+        """
+        Yield a (name, GID, members) tuple for each usable line of a group
+        format file. Anything else is rejected.
+        """
+        seen = set()
+        for (lineno, line) in enumerate(f, 1):
+            line = line.rstrip()
+            if not line.strip():
+                continue
+
+            fields = line.split(':')
+            if len(fields) != 4:
+                self.reject(f.name, lineno, line, "expected 4 fields")
+                continue
+            (name, password, GID, members) = fields
+
+            if not name:
+                self.reject(f.name, lineno, line, "no group name")
+                continue
+            if not GID.isdigit():
+                self.reject(f.name, lineno, line, "GID must be a number")
+                continue
+            if name in seen:
+                self.reject(f.name, lineno, line, "duplicate group name")
+                continue
+            seen.add(name)
+
+            yield (name, int(GID), [m.strip() for m in members.split(',') if m.strip()])
+
 
 config = configparser.ConfigParser()
 config.read(['/etc/bluepages.cfg', os.path.expanduser('~/.bluepages.cfg'), './bluepages.cfg'])
@@ -17,14 +171,26 @@ description="A script to convert a passwd file format to sqlite database."
 parser = argparse.ArgumentParser(description=description)
 parser.add_argument('-d', '--db', metavar="DATABASE",
          default=config.get('global', 'db', fallback='bp.db'))
-parser.add_argument('-p', '--passwd', metavar="FILE", 
+parser.add_argument('-p', '--passwd', metavar="FILE",
         default=config.get('global', 'passwd', fallback='/etc/passwd'))
+parser.add_argument('-g', '--group', metavar="FILE", default=None,
+        help='also import groups from a group format file (note that '
+        'syncbp.py will replace these with the configured groups)')
 parser.add_argument('-s', '--status',  default="inactive", help='initial user status (default: inactive)')
+parser.add_argument('-m', '--merge', action="store_true",
+        help='merge into an existing database, updating any users which '
+        'are already there (their status is left alone)')
+parser.add_argument('-r', '--rejects', metavar="FILE", default=None,
+        help='write lines which could not be imported to this file, '
+        'along with the file and line they came from and the reason')
+parser.add_argument('-c', '--chunk-size', type=int, default=10000,
+        help='number of rows to write at once (default: 10000)')
 
 args = parser.parse_args()
 
-if os.path.exists(args.db):
+if os.path.exists(args.db) and not args.merge:
     print("ERROR: File %s already exists! Will not clobber." % (args.db))
+    print("Use --merge to import into an existing database.")
     sys.exit(1)
 
 try:
@@ -35,44 +201,63 @@ except:
 
 
 cur = con.cursor()
+bpdb.set_pragmas(cur, config.get('global', 'journal_mode', fallback='wal'))
 
-# create the table
-cur.execute("""CREATE TABLE passwd
-        (name text NOT NULL PRIMARY KEY, 
-            sAMAccountName text NOT NULL UNIQUE,
-            password text, UID text, GID text, GECOS text,
-            directory text, shell text, status text,
-            givenName text, sn text)""")
+# create the tables, or bring them up to date when merging
+try:
+    bpdb.upgrade(cur)
+except ValueError as e:
+    print(f"ERROR: {e}")
+    sys.exit(2)
+
+rejects = None
+if args.rejects:
+    rejects = open(args.rejects, 'w')
+
+# by default set all users to inactive
+importer = Importer(cur, args.status, rejects)
+existing_names = set(importer.accounts.values())
+
+# when merging, a user who is already there has the fields from the passwd
+# file updated but keeps their status and names
+merge_columns = ('password', 'UID', 'GID', 'GECOS', 'directory', 'shell')
+
+start = time.perf_counter()
+added = 0
+updated = 0
 
 with open(args.passwd) as f:
-    for line in f:
-        try:
-            (name, password, UID, GID, GECOS, directory, shell) = line.rstrip().split(':')
-        except:
-            print("WARNING: could not parse entry %s" % (line))
-            continue
-
-        # by default set all users to inactive
-        status = args.status
-
-        # set the givenName and sn fields to the same as the username
-        # unless it splits (eg firstname.lastname format)
-        givenName = name
-        sn = name
-        try:
-            (givenName, sn) = name.title().split('.',1)
-        except:
-            pass
-
-
-        try:
-            cur.execute("""INSERT INTO passwd values 
-                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (name, name, 
-                            password, UID, GID, GECOS, directory, shell, 
-                            status, givenName, sn))
-        except:
-            print("WARNING: could not add user %s to database" % name)
+    for chunk in chunks(importer.parse_passwd(f), args.chunk_size):
+        bpdb.insert_users(cur, chunk, update=merge_columns)
+        for row in chunk:
+            if row['name'] in existing_names:
+                updated += 1
+            else:
+                added += 1
 
+groups = 0
+if args.group:
+    with open(args.group) as f:
+        for chunk in chunks(importer.parse_group(f), args.chunk_size):
+            cur.executemany("""INSERT INTO grp VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET GID = excluded.GID""",
+                    [(name, GID) for (name, GID, members) in chunk])
+            cur.executemany("INSERT OR IGNORE INTO group_member VALUES (?, ?)",
+                    [(name, member) for (name, GID, members) in chunk
+                        for member in members])
+            groups += len(chunk)
+
+# make sure the next export covers everything we've imported
+bpdb.set_export_pending(cur)
 
 con.commit()
 con.close()
+
+if rejects:
+    rejects.close()
+
+elapsed = time.perf_counter() - start
+rows = added + updated + groups
+print(f"Imported {added} new and {updated} existing users and {groups} groups "
+        f"in {elapsed:.2f}s ({rows / max(elapsed, 1e-6):.0f} rows/sec), "
+        f"{importer.rejected} rejected")
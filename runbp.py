@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+#
+# run a sync and export of the bluepages database, either once or
+# continuously as a daemon
+#
+
+import argparse
+import configparser
+import os
+import select
+import signal
+import socket
+import sqlite3
+import sys
+import time
+import ldap
+import bpdb
+import bpmetrics
+import exportbp
+import syncbp
+
+
+def read_config():
+    config = configparser.ConfigParser()
+    config.read(['/etc/bluepages.cfg', os.path.expanduser('~/.bluepages.cfg'), './bluepages.cfg'])
+    return config
+
+
+class Connection:
+    """
+    A directory connection which is kept open between runs. connect is the
+    function used to make the connection (eg syncbp.connect), which returns
+    False if there is no directory configured.
+
+    Before each run the connection is checked with a whoami and, if it has
+    gone away, a new one is made.
+    """
+
+    def __init__(self, connect, name):
+        self.connect = connect
+        self.name = name
+        self.directory = None
+
+    def get(self, config):
+        if self.directory:
+            try:
+                self.directory.whoami_s()
+            except ldap.LDAPError as e:
+                print(f"Lost connection to {self.name}, reconnecting: {e}")
+                self.reset()
+
+        if self.directory is None:
+            self.directory = self.connect(config)
+        return self.directory
+
+    def reset(self):
+        """Drop the connection, a new one is made on the next get()"""
+        if self.directory:
+            try:
+                self.directory.unbind_s()
+            except ldap.LDAPError:
+                pass
+        self.directory = None
+
+
+def run(config, con, ad, ldap_server, args, rebuild=False):
+    """
+    Do a sync and then an export, returning the result of the export. The
+    export only updates the users and groups changed by the sync, unless
+    rebuild is set.
+    """
+    start = time.perf_counter()
+
+    sync_metrics = bpmetrics.Metrics('syncbp')
+    directory = ad.get(config)
+    sync_metrics.lap("connect")
+    (changes, sync_metrics) = syncbp.sync(config, con, directory,
+            args.verbose, args.incremental, args.full, sync_metrics)
+    sync_metrics.write(config)
+    if args.verbose:
+        for (phase, seconds) in sync_metrics.phases.items():
+            print(f"{phase:>30}: {seconds:.3f}s")
+
+    if rebuild:
+        changes.rebuild = True
+    elif args.verbose:
+        print(f"{len(changes.users)} user(s) and {len(changes.groups)} "
+                "group(s) changed")
+
+    export_metrics = bpmetrics.Metrics('exportbp')
+    directory = ldap_server.get(config)
+    export_metrics.lap("connect")
+    (files_changed, ldap_changes) = exportbp.export(config, con, directory,
+            args.passwd, args.group, args.verbose, args.stream, changes,
+            metrics=export_metrics)
+    export_metrics.write(config)
+    if args.verbose:
+        for (phase, seconds) in export_metrics.phases.items():
+            print(f"{phase:>30}: {seconds:.3f}s")
+
+    if args.verbose:
+        print(f"Sync and export finished in {time.perf_counter() - start:.2f}s")
+    return (files_changed, ldap_changes)
+
+
+def trigger(path):
+    """Ask a running daemon to do a sync and export now"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        print(s.recv(1024).decode().strip())
+
+
+def daemon(config, con, args):
+    """
+    Run a sync and export every interval seconds, keeping the connections
+    to the directory and ldap server open in between. A run can be
+    started early by connecting to the trigger socket, or by sending a
+    SIGHUP, which also re-reads the configuration.
+    """
+    ad = Connection(syncbp.connect, "the directory")
+    ldap_server = Connection(exportbp.connect, "the ldap server")
+
+    # signals are handled by setting a flag, and writing to a pipe which
+    # wakes up the select() below
+    flags = {'reload': False, 'stop': False}
+    def handler(signum, frame):
+        if signum == signal.SIGHUP:
+            flags['reload'] = True
+        else:
+            flags['stop'] = True
+    (wake_r, wake_w) = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handler)
+
+    # the socket is only set up at startup, changing it needs a restart
+    listener = None
+    path = config.get('daemon', 'socket', fallback=None)
+    if path:
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen(5)
+
+    # the first run exports everything if asked to, as does the one after
+    # the configuration is re-read in case the change affects the entries
+    rebuild = args.rebuild
+    previous = None
+    next_run = time.monotonic()
+    while not flags['stop']:
+        timeout = max(0, next_run - time.monotonic())
+        readable = select.select([wake_r] + ([listener] if listener else []),
+                [], [], timeout)[0]
+
+        now = False
+        if wake_r in readable:
+            while True:
+                try:
+                    os.read(wake_r, 1024)
+                except BlockingIOError:
+                    break
+        if listener in readable:
+            (client, address) = listener.accept()
+            with client:
+                client.sendall(b"ok, starting a sync and export\n")
+            now = True
+
+        if flags['stop']:
+            break
+        if flags['reload']:
+            print("Re-reading the configuration")
+            flags['reload'] = False
+            (previous, config) = (config, read_config())
+            ad.reset()
+            ldap_server.reset()
+            rebuild = True
+            now = True
+
+        if now or time.monotonic() >= next_run:
+            try:
+                run(config, con, ad, ldap_server, args, rebuild)
+                rebuild = False
+                previous = None
+            except SystemExit:
+                # the sync or export didn't like a setting, and has already
+                # said which. if the configuration has just been re-read go
+                # back to the one we had, otherwise try again next time.
+                print("ERROR: sync and export failed on a configuration error")
+                con.rollback()
+                if previous:
+                    print("Going back to the previous configuration")
+                    (config, previous) = (previous, None)
+                    ad.reset()
+                    ldap_server.reset()
+            except Exception as e:
+                # drop the connections in case they are the problem, they
+                # will be made again on the next run
+                print(f"ERROR: sync and export failed: {e!r}")
+                con.rollback()
+                ad.reset()
+                ldap_server.reset()
+            try:
+                interval = config.getint('daemon', 'interval', fallback=300)
+            except ValueError as e:
+                print(f"ERROR: {e}, running again in 300 seconds")
+                interval = 300
+            next_run = time.monotonic() + interval
+
+    print("Stopping")
+    if listener:
+        listener.close()
+        os.unlink(path)
+    ad.reset()
+    ldap_server.reset()
+
+
+def main():
+    config = read_config()
+
+    description="A script to sync and export the bluepages database, once or as a daemon."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d', '--db', metavar="DATABASE",
+            default=config.get('global', 'db', fallback='bp.db'))
+    parser.add_argument('-p', '--passwd', metavar="FILE",
+            default=config.get('global', 'passwd', fallback='passwd'))
+    parser.add_argument('-g', '--group', metavar="FILE",
+            default=config.get('global', 'group', fallback='group'))
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('-i', '--incremental', action="store_true",
+            help='only sync groups which have changed since the last run')
+    parser.add_argument('-f', '--full', action="store_true",
+            help='force a full sync even if incremental sync is enabled')
+    parser.add_argument('--stream', action="store_true",
+            default=config.getboolean('ldap', 'stream', fallback=False),
+            help='merge sorted ldap results with the database rather than '
+            'loading all existing ldap entries into memory')
+    parser.add_argument('-r', '--rebuild', action="store_true",
+            help='export every user and group rather than just the ones '
+            'changed by the sync')
+    parser.add_argument('-D', '--daemon', action="store_true",
+            help='keep running, doing a sync and export every interval '
+            'seconds (set in the [daemon] section)')
+    parser.add_argument('-t', '--trigger', action="store_true",
+            help='ask a running daemon to do a sync and export now')
+    args = parser.parse_args()
+
+    if args.trigger:
+        try:
+            trigger(config['daemon']['socket'])
+        except (KeyError, OSError) as e:
+            print(f"ERROR: Could not contact the daemon: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if 'nis' in config:
+        try:
+            import dbm.gnu
+        except ImportError:
+            print("ERROR: The python gdbm module (dbm.gnu) is needed to write NIS maps")
+            sys.exit(2)
+
+    try:
+        con = sqlite3.connect(args.db)
+    except:
+        print("ERROR: Could not open database %s" % (args.db))
+        sys.exit(2)
+
+    # bring the database schema up to date before anything else uses it
+    try:
+        bpdb.upgrade(con.cursor())
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(2)
+
+    if args.daemon:
+        # make sure messages get to the log as they happen
+        sys.stdout.reconfigure(line_buffering=True)
+        daemon(config, con, args)
+        con.close()
+        sys.exit(0)
+
+    ad = Connection(syncbp.connect, "the directory")
+    ldap_server = Connection(exportbp.connect, "the ldap server")
+    (files_changed, ldap_changes) = run(config, con, ad, ldap_server, args,
+            args.rebuild)
+    con.close()
+
+    if ldap_changes['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
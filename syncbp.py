@@ -5,259 +5,1097 @@
 #
 
 import argparse
+import collections
+import concurrent.futures
 import configparser
+import contextlib
 import sqlite3
 import sys
 import os
 import ldap
-import struct
 import json
 import re
+import time
+import hashlib
+import ldap.filter
+import bpdb
+import bpfiles
+import bpldap
+import bpmetrics
+import bpuid
+
+
+def read_usn(directory):
+    """
+    Return the dsServiceName and highestCommittedUSN of the DC we are
+    bound to from its rootDSE. USNs are local to each DC so the service
+    name is kept alongside the USN to tell if we are talking to another one.
+    Both are None if the rootDSE doesn't have them (it isn't AD, or we
+    aren't allowed to read them), in which case only full syncs can be done.
+    """
+    results = directory.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+            ['dsServiceName', 'highestCommittedUSN'])
+    attrs = results[0][1] if results else {}
+    if not attrs.get('dsServiceName') or not attrs.get('highestCommittedUSN'):
+        return (None, None)
+    return (str(attrs['dsServiceName'][0], encoding='utf-8'),
+            int(attrs['highestCommittedUSN'][0]))
+
+
+def config_hash(config, sections):
+    """
+    Return a hash of the settings which affect the sync, so that a config
+    change can force a full sync
+    """
+    settings = {section: dict(config[section]) for section in sections}
+    for section in directory_sections(config):
+        settings[section] = {'dn': config[section].get('dn'),
+            'sid_offset': config[section].get('sid_offset'),
+            'sid_slice': config[section].get('sid_slice')}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def full_sync_reason(config, old_state, new_state):
+    """
+    Return the reason an incremental sync can't be done, or None if the
+    state saved by the last run is still valid
+    """
+    if new_state['highestCommittedUSN'] is None:
+        return "the directory doesn't publish a highestCommittedUSN"
+    if 'highestCommittedUSN' not in old_state:
+        return "no previous sync state"
+    if old_state.get('dsServiceName') != new_state['dsServiceName']:
+        return "the domain controller has changed"
+    if int(old_state['highestCommittedUSN']) > new_state['highestCommittedUSN']:
+        return "the domain controller USN has gone backwards"
+    if old_state.get('config_hash') != new_state['config_hash']:
+        return "the configuration has changed"
+
+    interval = int(config.get('directory', 'full_sync_interval',
+            fallback=86400))
+    if time.time() - int(old_state.get('last_full_sync', 0)) > interval:
+        return "the full sync interval has passed"
+
+    return None
+
+
+def changed_group_sections(source, groups, usn, page_size=1000):
+    """
+    Return the group sections which have had their membership changed in
+    the source since the given USN, out of groups (a dict of group section
+    to its dns in the source).
+
+    Adding or removing a member updates the uSNChanged of the group it
+    was added to, so find the groups changed since the last run and then
+    any groups which contain those (through nesting).
+    """
+    (directory, base) = (source.directory, source.base)
+    criteria = f"(&(objectClass=group)(uSNChanged>={usn + 1}))"
+    changed = set()
+    for (dn, attrs) in bpldap.paged_search(directory, base, ldap.SCOPE_SUBTREE,
+            criteria, ['distinguishedName'], page_size):
+        if not dn:
+            continue
+        changed.add(dn.lower())
+
+        criteria = "(&(objectClass=group)(member:1.2.840.113556.1.4.1941:=%s))" % (
+                ldap.filter.escape_filter_chars(dn))
+        for (parent, attrs) in bpldap.paged_search(directory, base,
+                ldap.SCOPE_SUBTREE, criteria, ['distinguishedName'], page_size):
+            if parent:
+                changed.add(parent.lower())
+
+    return [section for (section, dns) in groups.items()
+            if any(dn.lower() in changed for dn in dns)]
+
+
+def still_provisioned(config, source, groups, name):
+    """
+    Return True if the named user is a member of any provisioning group
+    out of groups (a dict of group section to its dns in the source)
+    """
+    dns = [dn for (section, group_dns) in groups.items()
+            if config[section].get('provisioning', False) for dn in group_dns]
+    if not dns:
+        return False
+
+    criteria = "(&(objectCategory=person)(objectClass=user)(sAMAccountName=%s)(|%s))" % (
+            ldap.filter.escape_filter_chars(name),
+            "".join(f"(memberOf:1.2.840.113556.1.4.1941:={dn})" for dn in dns))
+    results = source.directory.search_s(source.base,
+            ldap.SCOPE_SUBTREE, criteria, ['sAMAccountName'])
+    return any(dn for (dn, attrs) in results)
+
+
+class AccountCache(dict):
+    """
+    The accounts found in the directory during a run, keyed by lower case
+    DN, so an account which is in several groups is only decoded once and
+    the groups share it. Each is a dict of the lower case account name, the
+    displayName, givenName and sn (the account name if they aren't set) and
+    the objectSid, or None if the result isn't an account. The rest of what
+    ldap hands back is dropped as soon as it has been decoded.
+    """
+
+    def decode(self, dn, attrs):
+        key = dn.lower()
+        if key not in self:
+            self[key] = None
+            # values come back from ldap as a byte string in a list so
+            # we need to mangle them back into a sane format
+            if 'sAMAccountName' in attrs:
+                name = str(attrs['sAMAccountName'][0], encoding='utf-8').lower()
+                account = {'name': name, 'objectSid': attrs.get('objectSid', [None])[0]}
+                for field in ('displayName', 'givenName', 'sn'):
+                    account[field] = name
+                    if field in attrs:
+                        account[field] = str(attrs[field][0], encoding='utf-8')
+                self[key] = account
+        return self[key]
+
+    def add(self, found, results):
+        """
+        Decode the (dn, attrs) results as they arrive into found, a dict of
+        lower case DN to account, skipping referrals
+        """
+        for (dn, attrs) in results:
+            if dn:
+                found[dn.lower()] = self.decode(dn, attrs)
+
+
+def expand_groups(source, groups, attributes, accounts, page_size=1000):
+    """
+    Return a dict of each group section to its members, as a dict of lower
+    case DN to the account decoded into accounts (an AccountCache),
+    following nested groups, from one search for every group and one for
+    every user rather than a chain rule search per group. groups is a dict
+    of group section to its dns in the source.
+
+    The memberOf of each group gives the graph of nesting, which is walked
+    once for each group (AD allows loops, so we keep track of where we've
+    been). Each user is then put in the sections its groups are nested in.
+    Like the chain rule, memberOf doesn't include a user's primary group.
+
+    The memberOf of every group is held while the users are read, and each
+    user is decoded as its page arrives, so memory grows with the number of
+    groups, accounts and memberships but not with the raw search results.
+    """
+    (directory, base) = (source.directory, source.base)
+    wanted = {}
+    for (section, dns) in groups.items():
+        for dn in dns:
+            wanted.setdefault(dn.lower(), []).append(section)
+
+    parents = {}
+    for (dn, attrs) in bpldap.paged_search(directory, base, ldap.SCOPE_SUBTREE,
+            "(objectClass=group)", ['memberOf'], page_size):
+        if dn:
+            parents[dn.lower()] = [str(v, encoding='utf-8').lower()
+                    for v in attrs.get('memberOf', [])]
+
+    # the sections each group is in, directly or through nesting
+    nested = {}
+    def sections_of(group):
+        if group not in nested:
+            seen = {group}
+            todo = [group]
+            while todo:
+                for parent in parents.get(todo.pop(), ()):
+                    if parent not in seen:
+                        seen.add(parent)
+                        todo.append(parent)
+            nested[group] = [section for dn in seen for section in wanted.get(dn, ())]
+        return nested[group]
+
+    members = {section: {} for section in groups}
+    criteria = "(&(objectCategory=person)(objectClass=user))"
+    for (dn, attrs) in bpldap.paged_search(directory, base, ldap.SCOPE_SUBTREE,
+            criteria, attributes + ['memberOf'], page_size):
+        if not dn:
+            continue
+        found = set()
+        for group in attrs.get('memberOf', []):
+            found.update(sections_of(str(group, encoding='utf-8').lower()))
+        if found:
+            account = accounts.decode(dn, attrs)
+            for section in found:
+                members[section][dn.lower()] = account
+    return members
+
+
+def compare_members(name, server, local):
+    """
+    Warn if the members of a group from a chain rule search and from
+    expand_groups() differ, returning True if they are the same. Both are
+    dicts keyed by lower case DN.
+    """
+    (server, local) = (server.keys(), local.keys())
+    if server == local:
+        return True
+    print(f"WARNING: local expansion of group {name} differs from the directory: "
+            f"{len(server - local)} missing, {len(local - server)} extra")
+    return False
+
+
+def directory_sections(config):
+    """
+    The config sections describing the directories users are synced from:
+    [directory] and then a [directory:name] section for each extra domain
+    """
+    if 'directory' not in config:
+        return []
+    return ['directory'] + [section for section in config
+            if section.startswith('directory:')]
+
+
+class Source:
+    """
+    A directory users are synced from, with its own base dn, bind details
+    and SID offset and slice. dc can be a comma separated list of DCs, which
+    are tried in order: connecting gives up after timeout seconds and
+    waiting for a page of search results after search_timeout, at which
+    point the next DC is tried. Settings missing from a [directory:name]
+    section are taken from [directory].
+
+    The directory work for a sync is done with run(), which moves on to the
+    next DC and starts that piece of work again if the one we're using
+    fails. Only run() touches the connection, so each source can be worked
+    on in its own thread.
+    """
+
+    def __init__(self, config, section):
+        def setting(key, fallback=None):
+            return config.get(section, key,
+                    fallback=config.get('directory', key, fallback=fallback))
+
+        self.section = section
+        self.name = section.partition(':')[2] or section
+        self.dcs = [dc.strip() for dc in setting('dc', '').split(',') if dc.strip()]
+        self.base = config[section]['dn']
+        (self.binduser, self.bindpw) = (setting('binduser'), setting('bindpw'))
+        self.sid_map = bpuid.SIDMapper(setting('sid_offset', 200000),
+                setting('sid_slice', 20000))
+        self.timeout = float(setting('timeout', 10))
+        self.search_timeout = float(setting('search_timeout', 120))
+
+        # sync state is kept under the source's name, apart from [directory]
+        # which uses the keys it always has
+        self.prefix = '' if section == 'directory' else f"{section}."
+
+        self.directory = None
+        self.current = 0
+        self.reset_run()
+
+    def reset_run(self):
+        """Forget what was found in the last sync"""
+        self.failed = None
+        self.service = self.usn = self.state_dc = None
+        self.changed = set()
+        self.members = {}
+        self.timings = collections.defaultdict(float)
+        self.mismatches = 0
+
+    @property
+    def dc(self):
+        return self.dcs[self.current] if self.dcs else None
+
+    def _connect(self):
+        directory = ldap.initialize(f"ldap://{self.dc}")
+        directory.set_option(ldap.OPT_REFERRALS, 0)
+        directory.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        directory.timeout = self.search_timeout
+        directory.simple_bind_s(self.binduser, self.bindpw)
+        self.directory = directory
+
+    def reset(self):
+        """Drop the connection, the next run() makes a new one"""
+        if self.directory:
+            try:
+                self.directory.unbind_s()
+            except ldap.LDAPError:
+                pass
+        self.directory = None
+
+    def run(self, func):
+        """
+        Return func(self), connecting if need be. If there is an ldap error
+        try again on each of the other DCs in turn, raising the last error
+        if they all fail.
+        """
+        error = ldap.SERVER_DOWN(f"no dc set for {self.section}")
+        for attempt in range(len(self.dcs)):
+            try:
+                if self.directory is None:
+                    self._connect()
+                return func(self)
+            except ldap.LDAPError as e:
+                print(f"WARNING: {self.dc} ({self.name}) failed: {e}")
+                error = e
+                self.reset()
+                self.current = (self.current + 1) % len(self.dcs)
+        raise error
+
+    def timed(self, search, func):
+        """Call func, adding the time it takes to the named search"""
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.timings[search] += time.perf_counter() - start
+
+    def state(self, sync_state):
+        """The saved sync state as this source sees it, with its own USN"""
+        state = dict(sync_state)
+        for key in ('dsServiceName', 'highestCommittedUSN'):
+            state.pop(key, None)
+            if self.prefix + key in sync_state:
+                state[key] = sync_state[self.prefix + key]
+        return state
+
+    def read_usn(self):
+        def read(source):
+            return read_usn(source.directory)
+        (self.service, self.usn) = self.timed('rootDSE', lambda: self.run(read))
+        self.state_dc = self.dc
+
+    def find_changed(self, groups, usn, page_size):
+        def find(source):
+            return changed_group_sections(source, groups, usn, page_size)
+        self.changed = set(self.timed('changed groups', lambda: self.run(find)))
+
+    def fetch(self, config, groups, everything, attributes, page_size, expand):
+        """
+        Find the members of the groups (a dict of group section to its dns
+        in this source), as decoded accounts. With local expansion the
+        members of every one of this source's groups (everything) are found,
+        as it costs nothing extra.
+
+        Each page of results is decoded as it arrives and then dropped, so
+        what is held is one decoded account per user found plus a reference
+        to it for each group they are in, along with the pages of the
+        searches kept in flight. That still grows with the size of the
+        groups, as every group is read before any of them is processed.
+        """
+        def fetch(source):
+            accounts = AccountCache()
+            members = {}
+            expanded = None
+            if expand != 'server':
+                expanded = source.timed('expand groups', lambda: expand_groups(
+                        source, everything, attributes, accounts, page_size))
+            if expand == 'local':
+                for section in everything:
+                    members[section] = list(expanded[section].values())
+                return members
+
+            # several searches are kept in flight at once so the DC round
+            # trips overlap. AD only allows 10 paged searches per connection
+            # by default so don't go too wild with the window.
+            searches = bpldap.SearchQueue(source.directory, int(config.get(
+                    'directory', 'max_concurrent_searches', fallback=4)))
+            for (section, dns) in groups.items():
+                for dn in dns:
+                    # set the ldap filter to find users who are members of this group
+                    # the mad looking numbers are a microsoft rule OID which returns
+                    # all members of the group (including those via nested groups)
+                    # https://docs.microsoft.com/en-gb/windows/win32/adsi/search-filter-syntax
+                    criteria = f"(&(objectCategory=person)(objectClass=user)(memberOf:1.2.840.113556.1.4.1941:={dn}))"
+                    searches.add((section, dn), source.base, ldap.SCOPE_SUBTREE,
+                            criteria, attributes, page_size)
+            for (section, dns) in groups.items():
+                # the results are fetched a page at a time so large groups
+                # aren't cut off at the server size limit, and each member
+                # is decoded as its page arrives. someone can be in more
+                # than one of the dns, they only count once.
+                found = {}
+                for dn in dns:
+                    source.timed(config[section]['name'], lambda: accounts.add(
+                            found, searches.results((section, dn))))
+                if expand == 'check' and not compare_members(
+                        config[section]['name'], found, expanded[section]):
+                    source.mismatches += 1
+                members[section] = list(found.values())
+            return members
+
+        self.members = self.run(fetch)
+
+
+class Sources(list):
+    """
+    The directories to sync from, as returned by connect(). whoami_s() and
+    unbind_s() are there so this can stand in for a connection when it is
+    kept open between runs.
+    """
+
+    def whoami_s(self):
+        for source in self:
+            if source.directory:
+                source.directory.whoami_s()
+
+    def unbind_s(self):
+        for source in self:
+            source.reset()
+
+
+def in_parallel(sources, func):
+    """
+    Call func(source) for each source in its own thread. Sources where it
+    fails on every DC get the error recorded in their failed attribute.
+    """
+    def call(source):
+        try:
+            func(source)
+        except ldap.LDAPError as e:
+            print(f"ERROR: could not reach any dc for {source.name}: {e}")
+            source.failed = e
+
+    sources = [source for source in sources if not source.failed]
+    if len(sources) == 1:
+        call(sources[0])
+    elif sources:
+        with concurrent.futures.ThreadPoolExecutor(len(sources)) as pool:
+            list(pool.map(call, sources))
+
+
+def group_sources(config, sections, sources):
+    """
+    Return a dict of each group section to a dict of the sources it is
+    in, and its dns in each. A group's dn can be a list of dns, one per
+    line, to merge groups from several domains into one. Each dn belongs to
+    the source whose base dn it is under, or the first if there isn't one.
+    """
+    found = {}
+    for section in sections:
+        dns = [dn.strip() for dn in config[section].get('dn', '').splitlines()
+                if dn.strip()]
+        in_source = collections.defaultdict(list)
+        for dn in dns if sources else []:
+            under = [source for source in sources
+                    if dn.lower().endswith(',' + source.base.lower())]
+            in_source[max(under, key=lambda source: len(source.base))
+                    if under else sources[0]].append(dn)
+        # in the order the sources are in the config
+        found[section] = {source: in_source[source] for source in sources
+                if source in in_source}
+    return found
+
+
+def connect(config):
+    """
+    Return the Sources to sync from, or False if there isn't a directory
+    configured. Each source connects to its first working DC when it is
+    first used.
+    """
+    if 'directory' not in config:
+        return False
+    return Sources(Source(config, section) for section in directory_sections(config))
+
+
+def sync(config, con, directory, verbose=False, incremental=False, full=False,
+        metrics=None):
+    """
+    Sync the database with the directory (the Sources from connect(), or
+    False if there isn't one): users found in the provisioning groups are made active, or added
+    if they are new, and the members of each configured group are updated.
+
+    The changes are committed to the database. Returns a bpdb.ChangeSet
+    of the users and groups which changed, for an export to work from, and
+    the bpmetrics.Metrics for the sync (which are added to metrics if it is
+    given).
+    """
+    (plan, metrics) = plan_sync(config, con, directory, verbose, incremental,
+            full, metrics)
+    return (apply_sync(con, plan, metrics), metrics)
+
+
+def plan_sync(config, con, directory, verbose=False, incremental=False,
+        full=False, metrics=None, planning=False):
+    """
+    Work out what a sync would change, without changing the database.
+    Returns the plan, a dict which can be saved as json and given to
+    apply_sync(), and the bpmetrics.Metrics for the sync so far.
+
+    The plan has the users to add (as passwd rows), reactivate and
+    deactivate, the source to record for users found in a different one
+    (or for the first time), the groups to update with the members to add
+    and remove, the groups to delete, the sync state to save and the
+    changes for an export to work from.
+
+    Set planning if the plan is only going to be shown or saved, rather
+    than applied straight away, so the messages say what would be done.
+    """
+    # keep track of how long each phase of the sync takes, along with the
+    # directory searches and what we did
+    if metrics is None:
+        metrics = bpmetrics.Metrics('syncbp')
+    for name in ('users_added', 'users_reactivated', 'users_deactivated',
+            'uid_collisions'):
+        metrics.count(name, 0)
+
+    cur = con.cursor()
+    bpdb.set_pragmas(cur, config.get('global', 'journal_mode', fallback='wal'))
+
+    # create the tables if they don't exist, or upgrade them if they are
+    # from an older version
+    bpdb.upgrade(cur)
+
+    # the sync state table records the directory high-water mark from the last
+    # run so that an incremental sync only has to look at what has changed
+    sync_state = bpdb.create_sync_state_table(cur)
+
+    # since the user database is small put the whole thing in a dictionary
+    # so we can search it. the key is the AD username and the value is a dict
+    # of all the fields in that row of the database
+    nis_users = {}
+    for user in bpdb.get_users(cur).values():
+        nis_users[user['sAMAccountName'].lower()] = user
+
+    # index the UIDs already in use so new users can be given a unique one
+    uids = bpuid.UIDAllocator(user['UID'] for user in nis_users.values())
+
+    # the linux usernames in use, as a new user can't take one of these
+    nis_names = {user['name'] for user in nis_users.values()}
+
+    # the status of everyone before the sync, to work out who has changed
+    old_status = {key: user['status'] for (key, user) in nis_users.items()}
+
+    # changes to the passwd and group tables are gathered up as we go, to be
+    # written in one go by apply_sync()
+    reactivate_users = set()
+    new_users = []
+    user_sources = {}
+    group_updates = []
+    old_groups = dict(cur.execute("select name, GID from grp").fetchall())
+
+    # what we change is recorded so an export can update just those entries,
+    # unless there are changes from before which haven't been exported yet
+    changes = bpdb.ChangeSet()
+    changes.rebuild = sync_state.get('export_pending') == '1'
+
+    metrics.lap("load database")
 
-def sid2string(binary):
-    """Return a string representation of a SID
-    when given the binary format.
-    https://stackoverflow.com/a/52825313
-    """
-    version = struct.unpack('B', binary[0:1])[0]
-    # I do not know how to treat version != 1 (it does not exist yet)
-    assert version == 1, version
-    length = struct.unpack('B', binary[1:2])[0]
-    authority = struct.unpack(b'>Q', b'\x00\x00' + binary[2:8])[0]
-    string = 'S-%d-%d' % (version, authority)
-    binary = binary[8:]
-    assert len(binary) == 4 * length
-    for i in range(length):
-        value = struct.unpack('<L', binary[4*i:4*(i+1)])[0]
-        string += '-%d' % value
-    return string
-
-
-def sid2uid(sid):
-    """
-    Return a UID number for a user when supplied with a SID
-    This is a two step process
-
-    1. Find the RID part of the SID (this is the last part of the string)
-    https://devblogs.microsoft.com/oldnewthing/20040315-00/?p=40253
-
-    2. Add the rid to the offset for the domain, attempting to emulate
-    the process performed by sssd.
-    """
-    sidstring = sid2string(sid)
-
-    # get the last part of the SID string, the rid
-    rid = sidstring.split('-')[7]
-
-    # return the rid plus the offset
-    offset = int(config.get('directory', 'sid_offset', fallback=200000))
-    return offset + int(rid)
-
-
-def is_unique_uid(uid, users):
-    """
-    Return False (not unique) if the suppiled UID is found in the set 
-    of supplied users. Otherwise return True.
-    """
-    for user in users.values():
-        if user['UID'] == str(uid):
-            return False
-
-    return True
-
-
-# Load configuration values
-config = configparser.ConfigParser()
-config.read(['/etc/bluepages.cfg', os.path.expanduser('~/.bluepages.cfg'), './bluepages.cfg'])
-
-# process arguments
-description="A script to add newly discovered users to sqlite database"
-parser = argparse.ArgumentParser(description=description)
-parser.add_argument('-d', '--db', metavar="DATABASE", 
-        default=config.get('global', 'db', fallback='bp.db'))
-parser.add_argument('-v', '--verbose', action="store_true")
-args = parser.parse_args()
-
-# connect to sqlite database
-try:
-    con = sqlite3.connect(args.db)
-except:
-    print("ERROR: Could not open database %s" % (args.db))
-    sys.exit(2)
-cur = con.cursor()
-
-# create the passwd table if it doesn't exist
-cur.execute("""CREATE TABLE IF NOT EXISTS passwd
-        (name text NOT NULL PRIMARY KEY,
-            sAMAccountName text NOT NULL UNIQUE,
-            password text, UID text, GID text, GECOS text,
-            directory text, shell text, status text,
-            givenName text, sn text)""")
-
-# since the user database is small put the whole thing in a dictionary
-# so we can search it. the key is the AD username and the value is a dict
-# of all the fields in that row of the database
-nis_users = {}
-for r in cur.execute("select * from passwd").fetchall():
-    user = dict(zip([c[0] for c in cur.description], r))
-    nis_users[user['sAMAccountName'].lower()] = user
-
-# set all active users to inactive (so we can then set the ad users
-# we find back to active)
-cur.execute("update passwd set status = 'inactive' where status = 'active'")
-
-# drop the group table and re-create it
-cur.execute("DROP TABLE IF EXISTS grp")
-cur.execute("""CREATE TABLE grp
-    (name text NOT NULL PRIMARY KEY,
-        GID text, user_list text)""")
-
-# connect to the directory if configured. disable referrals.
-directory = False
-if 'directory' in config:
-    directory = ldap.initialize(f"ldap://{config['directory']['dc']}")
-    directory.set_option(ldap.OPT_REFERRALS,0)
     attributes = ['sAMAccountName', 'displayName', 'givenName', 'sn', 'objectSid']
+    page_size = int(config.get('directory', 'page_size', fallback=1000))
 
-    directory.simple_bind_s(config['directory']['binduser'],
-            config['directory']['bindpw'])
+    # group membership is either found by a chain rule search of the
+    # directory for each group, or by expanding the nesting locally from a
+    # pull of every group and user (which is cheaper when there are a lot of
+    # groups). check does both, warns if they differ and uses the searches.
+    expand = config.get('directory', 'expand_groups', fallback='server')
+    if expand not in ('server', 'local', 'check'):
+        print(f"ERROR: expand_groups must be server, local or check, not {expand}")
+        sys.exit(2)
 
-# loop over each configured group.
-for section in config:
+    # the directories to sync from, and which of them each group is in.
+    # the directory work for each source runs in its own thread so a slow
+    # DC in one domain doesn't hold up the others.
+    sources = list(directory or [])
+    for source in sources:
+        source.reset_run()
+    group_sections = [section for section in config if "group:" in section]
+    sources_of = group_sources(config, group_sections, sources)
+    def groups_of(source, sections):
+        return {section: sources_of[section][source] for section in sections
+                if source in sources_of[section]}
 
-    # this is a small hack. what we're actually doing is looping over all
-    # the sections of the config, so if this section isn't one that describes
-    # a group then skip on to the next one.
-    if "group:" not in section:
-        continue
+    # decide whether we can get away with an incremental sync or need to do
+    # a full one. see full_sync_reason() for the details. every source has
+    # to be able to run incrementally for us to.
+    new_state = {'config_hash': config_hash(config, group_sections),
+            'last_full_sync': sync_state.get('last_full_sync', '0')}
+    # the USN is only read if it is going to be used, it costs a rootDSE
+    # search of every source
+    reason = "incremental sync is not enabled"
+    if incremental or config.getboolean('directory', 'incremental', fallback=False):
+        in_parallel(sources, lambda source: source.read_usn())
+        reason = None
+        for source in sources:
+            if source.failed:
+                continue
+            reason = full_sync_reason(config, source.state(sync_state),
+                    dict(new_state, dsServiceName=source.service,
+                        highestCommittedUSN=source.usn))
+            if reason:
+                if len(sources) > 1:
+                    reason = f"{reason} ({source.name})"
+                break
 
-    group = config[section]
-    if args.verbose:
-         print(f"Checking group {group['name']}")
-
-    # by default groups aren't used to provision users it has to be set
-    provisioning = group.get('provisioning', False)
-
-    # If there is a dn set for the group then search AD for it. If not just set
-    # the results set as empty. This might be more useful in future, but for now 
-    # all it lets you do is set a group to exist in NIS which is independent of
-    # the directory (but there is no way to add any members)
-    if group.get('dn') and directory:
-        # set the ldap filter to find users who are members of this group
-        # the mad looking numbers are a microsoft rule OID which returns 
-        # all members of the group (including those via nested groups)
-        # https://docs.microsoft.com/en-gb/windows/win32/adsi/search-filter-syntax
-        criteria = f"(&(objectCategory=person)(objectClass=user)(memberOf:1.2.840.113556.1.4.1941:={group['dn']}))"
-
-        # search the directory for all users in the group
-        results = directory.search_s(config['directory']['dn'], 
-                ldap.SCOPE_SUBTREE, criteria, attributes)
+    if full or reason:
+        incremental = False
+        if verbose:
+            print(f"Running a full sync: {full and 'requested' or reason}")
+
+        new_state['last_full_sync'] = str(int(time.time()))
+        sync_sections = group_sections
+
+        # remove any groups which are no longer configured
+        delete_groups = bpdb.stale_groups(cur,
+                [config[section]['name'] for section in group_sections])
+        changes.groups.update(delete_groups)
     else:
-        results = []
-        if args.verbose:
-            print(f"No dn set for group {group['name']} so not checking directory")
+        incremental = True
+        delete_groups = []
+        in_parallel(sources, lambda source: source.find_changed(
+                groups_of(source, group_sections),
+                int(source.state(sync_state)['highestCommittedUSN']), page_size))
+
+        # the USN only means something to the DC it came from, so if a source
+        # has moved to another DC all its groups have to be checked. a group
+        # in several sources is checked in all of them if any have changed.
+        def changed(source, section):
+            return section in source.changed or source.dc != source.state_dc
+        sync_sections = [section for section in group_sections
+                if any(changed(source, section) for source in sources_of[section])]
+        if verbose:
+            print(f"Running an incremental sync, {len(sync_sections)} group(s) "
+                    "have changed")
+
+    metrics.lap("check directory for changes")
+
+    in_parallel(sources, lambda source: source.fetch(config,
+            groups_of(source, sync_sections), groups_of(source, group_sections),
+            attributes, page_size, expand))
+
+    # if a source couldn't be reached at all its groups are left as they
+    # are, and nobody is deactivated as we can't tell if they are still in
+    # one of its groups. the sync state isn't saved so the next run catches
+    # up on what we missed.
+    failed = [source for source in sources if source.failed]
+    if failed:
+        print("WARNING: skipping the groups in " + ", ".join(source.name
+                for source in failed) + " and not deactivating any users")
+    for source in sources:
+        for (search, seconds) in source.timings.items():
+            metrics.add_time('directory_search_seconds', seconds,
+                    search=search, directory=source.name)
+        metrics.count('expansion_mismatches', source.mismatches,
+                directory=source.name)
+        metrics.count('directory_failed', int(bool(source.failed)),
+                directory=source.name)
+        if not source.failed and source.usn is not None \
+                and source.dc == source.state_dc:
+            new_state[source.prefix + 'dsServiceName'] = source.service
+            new_state[source.prefix + 'highestCommittedUSN'] = source.usn
+
+    metrics.lap("search directory")
 
-    # need to make a list of all the group members.
-    group_members = []
-    # add in any from the config file 
-    if 'members' in group:
-        group_members = group.get('members').split(',')
-        # strip any spaces that were between names in the file
-        group_members = [name.strip() for name in group_members]
-
-    # loop over all the found directory users
-    for (dn, account) in results:
-
-        # microsoft says those filters should be enough to only match 
-        # people but it seems other things can still come back so
-        # skip over anything that doesn't have an account name
-        # (I think this may be to do with referrals??)
-        if not 'sAMAccountName' in account:
+    # an account name can only belong to one source. the one a user was
+    # found in before keeps it, whichever groups have been fetched this
+    # time. otherwise if more than one has it, the first one in the config
+    # file gets it.
+    by_name = {source.name: source for source in sources}
+    owners = {key: by_name[user['source']] for (key, user) in nis_users.items()
+            if user['source'] in by_name}
+    for source in sources:
+        for accounts in source.members.values():
+            for account in accounts:
+                if account:
+                    owners.setdefault(account['name'], source)
+    conflicts = set()
+
+    # in an incremental sync keep track of anyone who drops out of a
+    # provisioning group, as they may need to be made inactive
+    removed_members = set()
+
+    # loop over each configured group.
+    for section in config:
+
+        # this is a small hack. what we're actually doing is looping over all
+        # the sections of the config, so if this section isn't one that describes
+        # a group then skip on to the next one.
+        if "group:" not in section:
             continue
 
-        # values come back from ldap as a byte string in a list so 
-        # we need to mangle name back into a sane format before we use it
-        name = str(account['sAMAccountName'][0], encoding='utf-8').lower()
+        # in an incremental sync only groups that have changed in the directory
+        # are checked, everything else is left as it was in the database
+        if section not in sync_sections:
+            continue
+
+        group = config[section]
+        if any(source.failed for source in sources_of[section]):
+            if verbose:
+                print(f"Not checking group {group['name']}, its directory is unavailable")
+            continue
+        if verbose:
+             print(f"Checking group {group['name']}")
+        group_start = time.perf_counter()
 
-        # apply some logic here to make sure bad usernames don't get from 
+        # by default groups aren't used to provision users it has to be set
+        provisioning = group.get('provisioning', False)
+
+        # If there is a dn set for the group then its members were found in
+        # the directory above. If not there are no results. This might be
+        # more useful in future, but for now all it lets you do is set a group
+        # to exist in NIS which is independent of the directory (but there
+        # is no way to add any members)
+        if verbose and not sources_of[section]:
+            print(f"No dn set for group {group['name']} so not checking directory")
+
+        # need to make a list of all the group members.
+        group_members = []
+        # add in any from the config file 
+        if 'members' in group:
+            group_members = group.get('members').split(',')
+            # strip any spaces that were between names in the file
+            group_members = [name.strip() for name in group_members]
+
+        # apply some logic here to make sure bad usernames don't get from
         # the directory into our database. If there's no regex set
         # in the config then just block users called root.
-        bad_user_regex = group.get('bad_user_regex', '^root$')
-        if re.match(bad_user_regex, name):
-            continue
+        bad_user_regex = re.compile(group.get('bad_user_regex', '^root$'))
 
-        # add the name to our members for this group
-        group_members.append(name)
+        for source in sources_of[section]:
 
-        # if this isn't a provisioning group then we don't need to bother
-        # with any other actions for the user.
-        if not provisioning:
-            continue
+            # directory users who aren't in NIS yet, they are added once we've
+            # been through the group so their SIDs can be mapped in one go
+            new_accounts = {}
 
-        # where we find a directory user who already has a NIS profile
-        # mark it as active
-        if name in nis_users:
-            cur.execute("""update passwd set status = 'active' where status = 
-                'inactive' and sAMAccountName = ?""", (name,))
-        # if the user found in the directory is not in NIS then add them
-        else: 
-            # Try to work out what UID sssd would generate from the user SID
-            uid = sid2uid(account['objectSid'][0])
-
-            # If the first UID we calculate is taken then look in the
-            # next slices until we find one that is available
-            while not is_unique_uid(uid, nis_users):
-                uid = uid + int(config.get('directory', 
-                    'sid_slice', fallback=20000))
-
-            # we expect most accounts to have a name attributes set
-            # but if they don't just re-use the account name
-            names = {'displayName': name, 'givenName': name, 'sn': name }
-            for field in names:
-                if field in account:
-                    names[field] = str(account[field][0], encoding='utf-8')
-
-            # build a dict that describes the new user
-            basedir = group.get('basedir', '/home')
-            user = {'name': name, 
-                    'sAMAccountName': name,
-                    'password': group.get('password', '!!'),
-                    'UID': uid,
-                    'GID': group['gid'],
-                    'GECOS': names['displayName'],
-                    'givenName': names['givenName'],
-                    'sn': names['sn'],
-                    'directory': f"{basedir}/{name}",
-                    'shell':  group.get('shell', '/sbin/nologin'),
-                    'status': 'active'}
-
-            print (f"Adding new user {name} ({user['UID']})")
-
-            # add that user to our set in memory 
-            # (just used for future loop iterations)
-            nis_users[name] = user
-
-            # and put it in the database
-            try:
-                cur.execute("""INSERT INTO passwd values
-                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (user['name'],
-                            user['sAMAccountName'], user['password'], 
-                            user['UID'], user['GID'], user['GECOS'], 
-                            user['directory'], user['shell'], user['status'], 
-                            user['givenName'], user['sn']))
-                        
-            except:
-                print("WARNING: could not add user %s to database" % user[0])
-
-    # update the group table. we store the list of members as a json
-    # so we can process it as a list in later steps.
-    cur.execute("INSERT INTO grp VALUES (?, ?, ?)", (group['name'], 
-            group['gid'], json.dumps(group_members)))
+            # loop over all the found directory users
+            for account in source.members[section]:
 
-    if args.verbose:
-        print(f"For group {group['name']} found members {group_members}")
+                # microsoft says those filters should be enough to only match 
+                # people but it seems other things can still come back so
+                # skip over anything that doesn't have an account name
+                # (I think this may be to do with referrals??)
+                if account is None:
+                    continue
+
+                name = account['name']
+                if bad_user_regex.match(name):
+                    continue
+
+                if owners[name] is not source:
+                    if name not in conflicts:
+                        print(f"WARNING: user {name} in {source.name} is "
+                                f"already in {owners[name].name}, skipping")
+                        conflicts.add(name)
+                    continue
+
+                # add the name to our members for this group
+                group_members.append(name)
 
+                # remember which source the user is from, if we didn't know
+                if name in nis_users and nis_users[name]['source'] != source.name:
+                    user_sources[nis_users[name]['sAMAccountName']] = source.name
+
+                # if this isn't a provisioning group then we don't need to bother
+                # with any other actions for the user.
+                if not provisioning:
+                    continue
+
+                # where we find a directory user who already has a NIS profile
+                # mark it as active
+                if name in nis_users:
+                    reactivate_users.add(name)
+                # if the user found in the directory is not in NIS then add them
+                else: 
+                    new_accounts[name] = account
+
+            # Try to work out what UIDs sssd would generate from the user SIDs
+            first_choices = source.sid_map.uids([account['objectSid']
+                    for account in new_accounts.values()])
+            for (name, account, first_choice) in zip(new_accounts,
+                    new_accounts.values(), first_choices):
+
+                # If the first UID we calculate is taken then look in the
+                # next slices until we find one that is available
+                uid = uids.allocate(first_choice, source.sid_map.slice)
+                if uid != first_choice:
+                    metrics.count('uid_collisions')
+
+                # build a dict that describes the new user
+                basedir = group.get('basedir', '/home')
+                user = {'name': name, 
+                        'sAMAccountName': name,
+                        'password': group.get('password', '!!'),
+                        'UID': uid,
+                        'GID': int(group['gid']),
+                        'GECOS': account['displayName'],
+                        'givenName': account['givenName'],
+                        'sn': account['sn'],
+                        'directory': f"{basedir}/{name}",
+                        'shell':  group.get('shell', '/sbin/nologin'),
+                        'status': 'active',
+                        'source': source.name}
+
+                # add that user to our set in memory 
+                # (just used for future loop iterations)
+                nis_users[name] = user
+
+                # the linux username could already be taken by a user with
+                # a different AD account name
+                if name in nis_names:
+                    print("WARNING: could not add user %s to database" % name)
+                    continue
+
+                print(f"{planning and 'Would add' or 'Adding'} new user {name} ({user['UID']})")
+
+                # and queue it up to go in the database
+                nis_names.add(name)
+                changes.users.add(name)
+                new_users.append({column: user[column]
+                        for column in bpdb.PASSWD_COLUMNS})
+
+        # work out what has to change in the group table and the members of
+        # the group. only the members that have changed since the last sync
+        # are written.
+        (added, removed) = bpdb.group_member_changes(cur, group['name'],
+                group_members)
+        if added or removed or old_groups.get(group['name']) != int(group['gid']):
+            changes.groups.add(group['name'])
+            group_updates.append({'name': group['name'], 'gid': int(group['gid']),
+                    'add': sorted(added), 'remove': sorted(removed)})
+
+        # when syncing incrementally keep track of anyone who has been removed
+        # from a provisioning group
+        if incremental and provisioning:
+            removed_members.update(removed)
+
+        if verbose:
+            print(f"For group {group['name']} found members {group_members}")
+
+        metrics.add_time('group_seconds', time.perf_counter() - group_start,
+                group=group['name'])
+        metrics.count('group_members', len(group_members), group=group['name'])
+
+        metrics.lap("sync groups")
+
+
+    # a full sync deactivates everyone who wasn't found, but in an incremental
+    # sync we need to deactivate users who have left a provisioning group, as
+    # long as they are not still a member of another one
+    deactivate_users = []
+    if failed:
+        removed_members = set()
+    if expand == 'local' and removed_members:
+        provisioned_names = {account['name'] for source in sources
+                for section in groups_of(source, group_sections)
+                if config[section].get('provisioning', False)
+                for account in source.members[section] if account}
+    for name in sorted(removed_members):
+        if expand == 'local':
+            provisioned = name in provisioned_names
+        else:
+            provisioned = False
+            for source in sources:
+                groups = groups_of(source, group_sections)
+                def search(source):
+                    return still_provisioned(config, source, groups, name)
+                try:
+                    provisioned = source.timed('still provisioned',
+                            lambda: source.run(search))
+                except ldap.LDAPError as e:
+                    # if we can't tell, leave them be
+                    print(f"WARNING: could not check if {name} is still provisioned: {e}")
+                    provisioned = True
+                if provisioned:
+                    break
+        if not provisioned:
+            print(f"{planning and 'Would deactivate' or 'Deactivating'} user {name}")
+            deactivate_users.append((name,))
+    metrics.lap("check removed users")
+
+    # work out whose status is going to change. a full sync makes every
+    # active user inactive unless they were found again.
+    deactivate_all = not incremental and not failed
+    reactivate = []
+    deactivate = []
+    for (key, status) in old_status.items():
+        account = nis_users[key]['sAMAccountName']
+        if status == 'inactive' and account in reactivate_users:
+            reactivate.append(account)
+        elif status == 'active' and deactivate_all and account not in reactivate_users:
+            deactivate.append(account)
+    for (name,) in deactivate_users:
+        if old_status.get(name.lower()) == 'active':
+            deactivate.append(nis_users[name.lower()]['sAMAccountName'])
+    changes.users.update(reactivate, deactivate)
+    metrics.count('users_reactivated', len(reactivate))
+    metrics.count('users_deactivated', len(deactivate))
+    metrics.count('users_added', len(new_users))
+
+    # remember there are changes to export, in case we don't get as far as
+    # exporting them this time
+    if changes.users or changes.groups:
+        new_state['export_pending'] = '1'
+
+    # save the high-water mark for the next incremental sync, unless a
+    # source was missed, in which case the next run has to catch up
+    if failed:
+        new_state = {key: value for (key, value) in new_state.items()
+                if key == 'export_pending'}
+
+    plan = {'version': bpfiles.PLAN_VERSION, 'script': 'syncbp',
+            'created': int(time.time()), 'incremental': incremental,
+            'add_users': new_users, 'reactivate_users': sorted(reactivate),
+            'deactivate_users': sorted(deactivate),
+            'user_sources': dict(sorted(user_sources.items())),
+            'groups': group_updates,
+            'delete_groups': delete_groups,
+            'sync_state': {k: str(v) for (k, v) in new_state.items()},
+            'changes': {'users': sorted(changes.users),
+                'groups': sorted(changes.groups), 'rebuild': changes.rebuild}}
+    return (plan, metrics)
+
+
+def set_status(cur, names, old, new):
+    """
+    Change the status of the named users from old to new. The names are
+    put in a temporary table so they can all be changed with one statement.
+    """
+    cur.execute("""CREATE TEMP TABLE status_change
+        (sAMAccountName text NOT NULL PRIMARY KEY)""")
+    cur.executemany("INSERT OR IGNORE INTO status_change VALUES (?)",
+            [(name,) for name in names])
+    cur.execute("""update passwd set status = ? where status = ?
+        and sAMAccountName IN (select sAMAccountName from status_change)""",
+            (new, old))
+    cur.execute("DROP TABLE status_change")
+
+
+def apply_sync(con, plan, metrics=None):
+    """
+    Make the changes in a plan from plan_sync() and commit them, without
+    looking at the directory again. Returns the bpdb.ChangeSet of the users
+    and groups which changed.
+    """
+    cur = con.cursor()
+    bpdb.upgrade(cur)
+
+    bpdb.remove_groups(cur, plan['delete_groups'])
+    for group in plan['groups']:
+        cur.execute("INSERT OR REPLACE INTO grp VALUES (?, ?)", (group['name'],
+                group['gid']))
+        bpdb.update_group_members(cur, group['name'], group['add'],
+                group['remove'])
+
+    set_status(cur, plan['reactivate_users'], 'inactive', 'active')
+    set_status(cur, plan['deactivate_users'], 'active', 'inactive')
+    cur.executemany("UPDATE passwd SET source = ? WHERE sAMAccountName = ?",
+            [(source, name) for (name, source) in plan['user_sources'].items()])
+    bpdb.insert_users(cur, plan['add_users'])
+
+    cur.executemany("INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+            plan['sync_state'].items())
+
+    con.commit()
+    if metrics:
+        metrics.lap("write database")
+
+    changes = bpdb.ChangeSet()
+    changes.users.update(plan['changes']['users'])
+    changes.groups.update(plan['changes']['groups'])
+    changes.rebuild = plan['changes']['rebuild']
+    return changes
+
+
+def print_plan(plan):
+    """Print what a plan from plan_sync() would change"""
+    for user in plan['add_users']:
+        print(f"add user {user['name']} ({user['UID']})")
+    for name in plan['reactivate_users']:
+        print(f"reactivate user {name}")
+    for name in plan['deactivate_users']:
+        print(f"deactivate user {name}")
+    for group in plan['groups']:
+        print(f"update group {group['name']} ({group['gid']})" +
+                "".join(f" +{name}" for name in group['add']) +
+                "".join(f" -{name}" for name in group['remove']))
+    for name in plan['delete_groups']:
+        print(f"remove group {name}")
+    print(f"{len(plan['add_users'])} user(s) to add, "
+            f"{len(plan['reactivate_users'])} to reactivate and "
+            f"{len(plan['deactivate_users'])} to deactivate, "
+            f"{len(plan['groups'])} group(s) to update and "
+            f"{len(plan['delete_groups'])} to remove")
+
+
+def main():
+    # Load configuration values
+    config = configparser.ConfigParser()
+    config.read(['/etc/bluepages.cfg', os.path.expanduser('~/.bluepages.cfg'), './bluepages.cfg'])
+
+    # process arguments
+    description="A script to add newly discovered users to sqlite database"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d', '--db', metavar="DATABASE", 
+            default=config.get('global', 'db', fallback='bp.db'))
+    parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('-i', '--incremental', action="store_true",
+            help='only sync groups which have changed since the last run')
+    parser.add_argument('-f', '--full', action="store_true",
+            help='force a full sync even if incremental sync is enabled')
+    parser.add_argument('--plan', nargs='?', const='', metavar="FILE",
+            help='work out what a sync would change and print it, without '
+            'changing the database. the plan is saved to FILE if given, for --apply')
+    parser.add_argument('--json', action="store_true",
+            help='print the plan as json rather than a summary (with --plan)')
+    parser.add_argument('--apply', metavar="PLAN",
+            help='make the changes in a plan saved by --plan, without looking '
+            'at the directory again')
+    args = parser.parse_args()
+    if args.plan is not None and args.apply:
+        parser.error("--plan and --apply can't be used together")
+    if args.json and args.plan is None:
+        parser.error("--json can only be used with --plan")
+
+    # connect to sqlite database
+    try:
+        con = sqlite3.connect(args.db)
+    except:
+        print("ERROR: Could not open database %s" % (args.db))
+        sys.exit(2)
+
+    # bring the database schema up to date before anything else uses it
+    try:
+        bpdb.upgrade(con.cursor())
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(2)
+
+    metrics = bpmetrics.Metrics('syncbp')
+
+    if args.apply:
+        # the plan says what to change from, so it can only be applied to
+        # the database it was made from
+        try:
+            plan = bpfiles.load_plan(args.apply, 'syncbp')
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Could not read plan {args.apply}: {e}")
+            sys.exit(2)
+        if bpdb.fingerprint(con.cursor()) != plan['database']:
+            print(f"ERROR: The database has changed since {args.apply} was made")
+            sys.exit(2)
+        apply_sync(con, plan, metrics)
+    else:
+        directory = connect(config)
+        metrics.lap("connect")
+        # keep stdout for the plan itself if it is being printed as json
+        with contextlib.redirect_stdout(args.json and sys.stderr or sys.stdout):
+            (plan, metrics) = plan_sync(config, con, directory, args.verbose,
+                    args.incremental, args.full, metrics,
+                    planning=args.plan is not None)
+
+        if args.plan is not None:
+            plan['database'] = bpdb.fingerprint(con.cursor())
+            con.rollback()
+            con.close()
+            if args.json:
+                print(json.dumps(plan, indent=2))
+            else:
+                print_plan(plan)
+            if args.plan:
+                bpfiles.save_plan(plan, args.plan)
+            sys.exit(0)
+
+        apply_sync(con, plan, metrics)
+    con.close()
+
+    metrics.write(config)
+    if args.verbose:
+        for (phase, seconds) in metrics.phases.items():
+            print(f"{phase:>30}: {seconds:.3f}s")
 
-con.commit()
-con.close()
 
+if __name__ == '__main__':
+    main()
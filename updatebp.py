@@ -5,56 +5,144 @@
 #
 
 import argparse
+import collections
 import configparser
+import csv
+import json
 import sqlite3
 import sys
 import os
-import distutils.util
+import bpdb
+import bpmetrics
+import bpuid
 
-def pick_uid(cur):
+# for all the fields that exist for the user step through these 
+# so values can be set
+user_fields = ['name', 'sAMAccountName', 'password', 'UID', 'GID', 'GECOS', 
+  'givenName', 'sn', 'directory', 'shell', 'status']
+
+def manual_uid_start(config):
     """
-    Pick the first free uid from a 'manual' range, which is defined as the 
+    Return the start of the 'manual' uid range, which is defined as the
     slice below the one set for the domain users
     """
-
     offset = int(config.get('directory', 'sid_offset', fallback=400000))
     slice = int(config.get('directory', 'sid_slice', fallback=200000))
+    return offset - slice + 1
 
-    uid = offset - slice + 1
-    while cur.execute("select UID from passwd where uid = ?", (uid, )).fetchone():
-        uid += 1
-
-    return str(uid)
+def pick_uid(cur):
+    """
+    Pick the first free uid from a 'manual' range, which is defined as the 
+    slice below the one set for the domain users
+    """
+    uids = bpuid.UIDAllocator.from_db(cur)
+    return uids.first_free(manual_uid_start(config))
 
-def validate(entry, field):
-    """Do some very very basic valdation of the input for the user fields"""
+def field_problem(entry, field):
+    """
+    Return a (message, fatal) tuple if something looks wrong with the
+    input for one of the user fields, or None. A fatal problem means the
+    value can't be used, otherwise it is just unusual.
+    """
     if field in ['UID', 'GID']:
         try:
             int(entry)
         except ValueError:
-            print(f"The {field} field must be a number")
-            return False
+            return (f"The {field} field must be a number", True)
 
     if field in ["name", "sAMAccountName"]:
         # need some new validation here now that username tracking with AD is improved
-        return True
+        return None
     elif field == "password":
         locked_passwords = ['!', '!!', '*']
         if entry not in locked_passwords:
-            return confirm(f"Usual password values are {locked_passwords}. Are you sure you want to set {entry}?", "no")
+            return (f"Usual password values are {locked_passwords}", False)
     elif field == "directory":
         if not os.path.isdir(entry):
-            return confirm(f"The directory {entry} does not seem to exist? Are you sure?", "yes")
+            return (f"The directory {entry} does not seem to exist", False)
     elif field == "shell":
         if not os.path.isfile(entry):
-            return confirm(f"The file {entry} does not seem to exist? Are you sure?", "yes")        
+            return (f"The file {entry} does not seem to exist", False)
     elif field == "status":
         statuses = ['active', 'inactive', 'manual', 'disabled']
         if entry not in statuses:
-            print(f"Allowed status types are {statuses}")
-            return False
+            return (f"Allowed status types are {statuses}", True)
 
-    return True
+    return None
+
+def validate(entry, field):
+    """Do some very very basic valdation of the input for the user fields"""
+    problem = field_problem(entry, field)
+    if problem is None:
+        return True
+    (message, fatal) = problem
+    if fatal:
+        print(message)
+        return False
+    default = field == "password" and "no" or "yes"
+    return confirm(f"{message}. Are you sure you want to set {entry}?", default)
+
+def yes_no(value):
+    """
+    Return True or False for a yes or no answer or setting (y, yes, t, true,
+    on and 1, or n, no, f, false, off and 0), raising ValueError for
+    anything else, as distutils.util.strtobool did before python 3.12
+    dropped distutils.
+    """
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError(f"{value!r} is not yes or no")
+
+def default_group(config):
+    """
+    Return the config file block for the default group, whatever that
+    happens to be (the one with default_group set, or else the last one)
+    """
+    group = config['DEFAULT']
+    for section in config:
+        if "group:" not in section:
+            continue
+        group = config[section]
+        try:
+           if yes_no( config[section].get('default_group') ) :
+               break
+        except: 
+           pass
+    return group
+
+def new_user(config, username, status, uid):
+    """Build a dict with some defaults for a new user"""
+    group = default_group(config)
+
+    # Set a default home directory base
+    basehome = group.get('basedir', '/home')
+
+    # set the givenName and sn fields to the same as the username
+    # unless it splits (eg firstname.lastname format)
+    givenName = username
+    sn = username
+    try:
+        (givenName, sn) = username.title().split('.',1)
+    except:
+        pass
+
+    return {'name': username,
+            'sAMAccountName': username,
+            'password': "!!",
+            'UID': uid,
+            'GID': group.get('gid', '99'),
+            'GECOS': " ".join( (givenName,  sn)  ),
+            'givenName': givenName,
+            'sn': sn,
+            'directory': os.path.join( basehome, username ),
+            'shell': group.get('shell', '/sbin/nologin'),
+            'status': status,
+            'source': None }
 
 def confirm(question, default='yes'):
     """Prompts user for yes/no confirmation and returns True or 
@@ -73,10 +161,201 @@ def confirm(question, default='yes'):
     while True:
         try:
             resp = input(question + prompt).strip().lower() or default
-            return distutils.util.strtobool(resp)
+            return yes_no(resp)
         except ValueError:
             return confirm("Please respond with 'yes' or 'no'")
 
+def read_rows(f, format):
+    """
+    Yield a (line number, row, error) tuple for each row of a batch file,
+    which is CSV with a header line or JSON lines with an object on each.
+    The row is a dict of the columns which have a value, or None if the
+    line couldn't be read, in which case error says why.
+    """
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            if None in row:
+                yield (reader.line_num, None, "more fields than the header")
+                continue
+            yield (reader.line_num, {k: v.strip() for (k, v) in row.items()
+                    if v is not None and v.strip()}, None)
+        return
+
+    for (lineno, line) in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield (lineno, None, f"not valid json: {e}")
+            continue
+        if not isinstance(row, dict):
+            yield (lineno, None, "not a json object")
+            continue
+        yield (lineno, {k: str(v) for (k, v) in row.items()
+                if v is not None and str(v) != ''}, None)
+
+def plan_batch(cur, rows, status):
+    """
+    Check every row of a batch against the database and each other,
+    returning a list of (line number, username, action, user, errors,
+    warnings) for them. action is created, updated, unchanged or deleted
+    and user is the passwd row to write. Nothing is written.
+
+    Each row has the username to operate on (the name in the database, as
+    given on the command line for a single user), any of the user fields
+    to set and optionally delete. New users get the same defaults as
+    usual, with status if they don't give one, and those without a UID
+    are given the first free ones from the manual range once every row
+    has been checked, so they can't take one asked for further down.
+    """
+    users = bpdb.get_users(cur)
+    uids = bpuid.UIDAllocator(user['UID'] for user in users.values())
+
+    # who holds each linux username and account name as the rows are
+    # worked through, to catch renames into a name which is taken
+    names = {name: name for name in users}
+    accounts = {user['sAMAccountName']: name for (name, user) in users.items()}
+
+    results = []
+    seen = set()
+    for (lineno, row, error) in rows:
+        if row is None:
+            results.append((lineno, None, None, None, [error], []))
+            continue
+
+        username = row.pop('username', None) or row.get('name')
+        errors = []
+        warnings = []
+        if not username:
+            errors.append("no username")
+        elif username in seen:
+            errors.append("the user is already in an earlier row")
+        seen.add(username)
+
+        delete = False
+        try:
+            delete = yes_no(row.pop('delete', 'no'))
+        except ValueError:
+            errors.append("delete must be yes or no")
+        unknown = sorted(set(row) - set(user_fields))
+        if unknown:
+            errors.append(f"unknown field(s) {', '.join(unknown)}")
+        if errors:
+            results.append((lineno, username, None, None, errors, warnings))
+            continue
+
+        old = users.get(username)
+        if delete:
+            if old is None:
+                errors.append("no such user to delete")
+            elif row:
+                errors.append("a user can't be deleted and updated")
+            else:
+                names.pop(old['name'], None)
+                accounts.pop(old['sAMAccountName'], None)
+            results.append((lineno, username, 'deleted', None, errors, warnings))
+            continue
+
+        if old is None:
+            user = new_user(config, username, status, None)
+            action = 'created'
+        else:
+            user = dict(old)
+            action = 'updated'
+
+        for (field, value) in row.items():
+            problem = field_problem(value, field)
+            if problem and problem[1]:
+                errors.append(problem[0])
+            elif problem:
+                warnings.append(problem[0])
+            user[field] = int(value) if field in ('UID', 'GID') and not problem else value
+
+        if 'UID' in row and not errors:
+            if not uids.is_free(row['UID']) and (old is None
+                    or int(row['UID']) != old['UID']):
+                errors.append(f"UID {row['UID']} is already in use")
+            else:
+                uids.add(row['UID'])
+
+        # the linux username and account name have to stay unique
+        if names.get(user['name'], username) != username:
+            errors.append(f"the name {user['name']} is already in use")
+        if accounts.get(user['sAMAccountName'], username) != username:
+            errors.append(f"the account name {user['sAMAccountName']} is already in use")
+        if not errors:
+            if old is not None:
+                names.pop(old['name'], None)
+                accounts.pop(old['sAMAccountName'], None)
+            names[user['name']] = username
+            accounts[user['sAMAccountName']] = username
+
+        if old is not None and user == old:
+            action = 'unchanged'
+        results.append((lineno, username, action, user, errors, warnings))
+
+    # one pass to give new users without a UID the first free ones in the
+    # manual range, now that the UIDs asked for are all known
+    start = manual_uid_start(config)
+    for (lineno, username, action, user, errors, warnings) in results:
+        if user is not None and user['UID'] is None:
+            user['UID'] = uids.allocate(uids.first_free(start), 1)
+
+    return results
+
+def batch(con, f, format, status, check):
+    """
+    Update, create or delete the users in a batch file in one transaction,
+    printing what happens to each row. If any row has an error nothing is
+    changed. Returns whether the batch was applied (or would be, if check
+    is set).
+    """
+    cur = con.cursor()
+    results = plan_batch(cur, read_rows(f, format), status)
+
+    counts = collections.Counter()
+    for (lineno, username, action, user, errors, warnings) in results:
+        where = f"line {lineno}" + (f" ({username})" if username else "")
+        for message in errors:
+            print(f"ERROR: {where}: {message}")
+        for message in warnings:
+            print(f"WARNING: {where}: {message}")
+        if errors:
+            counts['error'] += 1
+        else:
+            counts[action] += 1
+            if user is not None and action == 'created':
+                print(f"line {lineno}: {username} {action} ({user['UID']})")
+            else:
+                print(f"line {lineno}: {username} {action}")
+
+    summary = ", ".join(f"{counts[action]} {action}" for action in
+            ('created', 'updated', 'deleted', 'unchanged'))
+    if counts['error']:
+        print(f"{counts['error']} row(s) have errors, nothing was changed ({summary} otherwise)")
+        return False
+    if check:
+        print(f"Checked, nothing was changed ({summary} otherwise)")
+        return True
+
+    # the old rows go first so renames and deletes free up their names
+    # before anyone else takes them
+    changed = [(username, user) for (lineno, username, action, user, errors,
+            warnings) in results if action != 'unchanged']
+    bpdb.delete_users(cur, [username for (username, user) in changed])
+    bpdb.insert_users(cur, [user for (username, user) in changed
+            if user is not None])
+    if changed:
+        bpdb.set_export_pending(cur)
+    con.commit()
+
+    for action in ('created', 'updated', 'deleted'):
+        metrics.count(f"users_{action}", counts[action])
+    print(summary)
+    return True
+
 
 config = configparser.ConfigParser()
 config.read(['/etc/bluepages.cfg', os.path.expanduser('~/.bluepages.cfg'), './bluepages.cfg'])
@@ -89,12 +368,41 @@ parser.add_argument('-d', '--db', metavar="DATABASE",
 parser.add_argument('--delete', action="store_true")
 parser.add_argument('-s', '--status',  default=None, help='change the user status')
 parser.add_argument('-v', '--verbose', action="store_true")
-parser.add_argument('username', 
+parser.add_argument('username', nargs='?',
         help='The user name in the identity provider to operate on' )
 parser.add_argument('-b', '--batchmode', action="store_true", 
         help='Run unattended and accept default values')
+parser.add_argument('-f', '--file', metavar="FILE",
+        help='update many users from FILE (- for stdin) without prompting. '
+        'Each row has a username, any of the user fields to set and '
+        'optionally delete=yes. Every row is checked before any are applied, '
+        'and they are applied together in one transaction. --status sets '
+        'the status of new users which do not give one')
+parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+        help='the format of FILE: csv with a header line or json lines '
+        '(default: jsonl if FILE ends in .jsonl or .json, otherwise csv)')
+parser.add_argument('-n', '--check', action="store_true",
+        help='with --file, only check the rows and report what would change')
 args = parser.parse_args()
 
+if args.file:
+    if args.username or args.delete:
+        parser.error("a username or --delete can't be given with --file")
+    if args.format is None:
+        args.format = args.file.endswith(('.jsonl', '.json')) and 'jsonl' or 'csv'
+elif not args.username:
+    parser.error("a username or --file is needed")
+
+# --status is used for new users in a batch as well as for a single user,
+# so check it before doing either
+if args.status is not None:
+    problem = field_problem(args.status, 'status')
+    if problem and problem[1]:
+        print(f"ERROR: {problem[0]}")
+        sys.exit(1)
+
+metrics = bpmetrics.Metrics('updatebp')
+
 if not os.path.exists(args.db):
     print("ERROR: File %s not found!" % (args.db))
     sys.exit(1)
@@ -109,23 +417,44 @@ except:
     sys.exit(2)
 cur = con.cursor()
 
+# bring the database schema up to date before anything else uses it
+try:
+    bpdb.upgrade(cur)
+except ValueError as e:
+    print(f"ERROR: {e}")
+    sys.exit(2)
+
+if args.file:
+    if args.file == '-':
+        ok = batch(con, sys.stdin, args.format, args.status or 'manual', args.check)
+    else:
+        with open(args.file, newline='', encoding='utf-8') as f:
+            ok = batch(con, f, args.format, args.status or 'manual', args.check)
+    con.close()
+    metrics.lap("batch")
+    if not args.check:
+        metrics.write(config)
+    sys.exit(0 if ok else 1)
+
 
 # search database to see if username parameter refers to an existing user
-sql="""SELECT * FROM passwd WHERE name = ?"""
-r =  cur.execute(sql, (args.username, )).fetchone()
+user = bpdb.get_user(cur, args.username)
 
-if r:
+if user:
     if args.delete:
         print("If you delete a user who exists still in AD they will be re-created!")
         print("In most cases setting the user status to disabled will be more useful")
         if args.batchmode or confirm(f"Are you really sure you want to delete {args.username}?", "no"):
-            sql="""DELETE FROM passwd WHERE name = ?"""
-            cur.execute(sql, (args.username, ))
+            bpdb.delete_users(cur, [args.username])
+            bpdb.set_export_pending(cur)
             con.commit()
             con.close()
+            metrics.count('users_deleted')
+            metrics.lap("write database")
+            metrics.write(config)
         sys.exit(0)
 
-    user = dict(zip([c[0] for c in cur.description], r))
+    operation = 'users_updated'
 
 else:
     if args.delete:
@@ -136,57 +465,16 @@ else:
          status = args.status
     else:
          status = 'manual'
-    # find the config file block for the default group,
-    # whatever that happens to be.
-    group = config['DEFAULT']
-    
-    for section in config:
-        if "group:" not in section:
-            continue
-        group = config[section]
-        try:
-           if distutils.util.strtobool ( config[section].get('default_group') ) :
-               break
-        except: 
-           pass
-       
-    
-    # Set a default home directory base
-    basehome = group.get('basedir', '/home')
-
-    # set the givenName and sn fields to the same as the username
-    # unless it splits (eg firstname.lastname format)
-    givenName = args.username
-    sn = args.username
-    try:
-        (givenName, sn) = args.username.title().split('.',1)
-    except:
-        pass
+    operation = 'users_created'
 
     # build a dict with some defaults for a new user    
-    user = {'name': args.username,
-            'sAMAccountName': args.username,
-            'password': "!!",
-            'UID': pick_uid(cur),
-            'GID': group.get('gid', '99'),
-            'GECOS': " ".join( (givenName,  sn)  ),
-            'givenName': givenName,
-            'sn': sn,
-            'directory': os.path.join( basehome, args.username ),
-            'shell': group.get('shell', '/sbin/nologin'),
-            'status': status }
+    user = new_user(config, args.username, status, pick_uid(cur))
 
 
 # Read any command line parameters to override default or those set
 if args.status:
     user['status'] = args.status
 
-# for all the fields that exist for the user step through these 
-# so values can be set
-user_fields = ['name', 'sAMAccountName', 'password', 'UID', 'GID', 'GECOS', 
-  'givenName', 'sn', 'directory', 'shell', 'status']
-
-
 for field in user_fields:
     valid = False
     while not valid and not args.batchmode:
@@ -203,17 +491,30 @@ print("")
 if not args.batchmode and not confirm("Are you sure you want to update bluepage database with these values?"):
     sys.exit(0)
 
+# the time spent waiting on the prompts isn't of interest
+metrics.lap("prompts")
+
+# UIDs are unique, so check nobody else has the one we've ended up with
+other = cur.execute("SELECT name FROM passwd WHERE UID = ? AND name != ?",
+        (int(user['UID']), args.username)).fetchone()
+if other:
+    print(f"ERROR: UID {user['UID']} is already used by {other[0]}")
+    sys.exit(1)
+
 # delete any previous entry for this user. use the supplied username
 # in case we are renaming a user in this process
-sql="""DELETE FROM passwd WHERE name = ?"""
-cur.execute(sql, (args.username, ))
+bpdb.delete_users(cur, [args.username])
 
 # put the new values in the database
-cur.execute("""INSERT INTO passwd values 
-        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (user['name'], 
-            user['sAMAccountName'], user['password'], user['UID'], 
-            user['GID'], user['GECOS'], user['directory'], user['shell'], 
-            user['status'], user['givenName'], user['sn']))
+bpdb.insert_users(cur, [user])
+
+# the change didn't come from a sync, so make sure the next export covers
+# everything
+bpdb.set_export_pending(cur)
 
 con.commit()
 con.close()
+
+metrics.count(operation)
+metrics.lap("write database")
+metrics.write(config)